@@ -0,0 +1,131 @@
+import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+from datetime import date, timedelta
+from log import Log
+from color import color
+import dashbox
+
+BREAKER_PATH = './Logs/breaker.json'
+FAILURE_THRESHOLD = 3 # Consecutive failed downloads before a unit is skipped
+PROBE_TIMEOUT = 3 # Seconds for the status page probe of a skipped unit
+BACKOFF_DAYS = [1, 2, 4, 7] # Days until the next full attempt after each failed retry, the last one repeats
+
+class CircuitBreaker:
+    '''
+    Per-unit circuit breaker persisted across runs.
+    After FAILURE_THRESHOLD consecutive failed downloads a unit is open: each run only probes its status page
+    with a short timeout and skips it unless the probe answers, with a full attempt on the BACKOFF_DAYS schedule.
+    A unit going offline and coming back is reported once instead of failing every night.
+    '''
+    def __init__(self, path: str = BREAKER_PATH, today: date = None):
+        self.path = path
+        self.today = today or date.today()
+        self._lock = threading.Lock()
+        self.states = {}
+        self._load()
+        self._reports = []
+        self._probes = {} # status url -> probe result, each dashbox is probed once per run
+
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.states = json.load(f)
+
+    @contextmanager
+    def _file_lock(self):
+        '''
+        Hold a lock on the state file, workqueue.py workers on several processes and hosts record into the same file
+        '''
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f'{self.path}.lock', 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.states, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def _state(self, unit_no) -> dict:
+        return self.states.setdefault(str(unit_no), {"failures": 0, "open": False, "offline_since": None, "retries": 0, "next_attempt": None})
+
+    @staticmethod
+    def probe(url: str, timeout: float = PROBE_TIMEOUT) -> bool:
+        '''
+        return: bool: True if the dashbox serves its status page (unit.status_url) within the timeout
+        '''
+        try:
+            dashbox.get(url, connect_timeout=timeout, read_timeout=timeout, retries=0)
+            return True
+        except Exception:
+            return False
+
+    def allow(self, unit_no, url: str) -> bool:
+        '''
+        Whether to attempt a full download of a unit in this run
+
+        param: unit_no: int: unit number
+        param: url: str: status page of the dashbox (unit.status_url), probed if the unit is open
+        return: bool: False if the unit should be skipped
+        '''
+        with self._lock:
+            state = dict(self._state(unit_no))
+        if not state["open"]:
+            return True
+        if self.today >= date.fromisoformat(state["next_attempt"]):
+            Log.write(f"Unit {unit_no}: Offline since {state['offline_since']}, scheduled retry")
+            return True
+        if url not in self._probes:
+            self._probes[url] = self.probe(url)
+        if self._probes[url]:
+            Log.write(f"Unit {unit_no}: Offline since {state['offline_since']}, status page answered, retrying")
+            return True
+        Log.write(f"Unit {unit_no}: Offline since {state['offline_since']}, skipped until {state['next_attempt']}")
+        print(f"{color.YELLOW}Unit {unit_no}: Offline since {state['offline_since']}, skipped{color.END}")
+        return False
+
+    def record(self, unit_no, ok: bool):
+        '''
+        Record the result of a full download attempt and save the state.
+        The state is read again first so results recorded by other workers are kept.
+        '''
+        with self._lock, self._file_lock():
+            self._load()
+            state = self._state(unit_no)
+            if ok:
+                if state["open"]:
+                    self._reports.append(f"Unit {unit_no}: Back online, was offline since {state['offline_since']}")
+                state.update({"failures": 0, "open": False, "offline_since": None, "retries": 0, "next_attempt": None})
+            else:
+                if state["failures"] == 0:
+                    state["offline_since"] = self.today.isoformat()
+                state["failures"] += 1
+                if state["open"]:
+                    state["retries"] += 1
+                elif state["failures"] >= FAILURE_THRESHOLD:
+                    state["open"] = True
+                    self._reports.append(f"Unit {unit_no}: Offline since {state['offline_since']} ({state['failures']} failed downloads), skipped until it answers again")
+                if state["open"]:
+                    backoff = BACKOFF_DAYS[min(state["retries"], len(BACKOFF_DAYS) - 1)]
+                    state["next_attempt"] = (self.today + timedelta(days=backoff)).isoformat()
+            self.save()
+
+    def is_open(self, unit_no) -> bool:
+        with self._lock:
+            return self._state(unit_no)["open"]
+
+    def reports(self) -> list[str]:
+        '''
+        Units that went offline or came back in this run, each reported once
+        '''
+        with self._lock:
+            reports, self._reports = self._reports, []
+        return reports
@@ -0,0 +1,147 @@
+import os
+import json
+import gzip
+import time
+import hashlib
+from collections import Counter
+from datetime import datetime
+from color import color
+
+CACHE_PATH = './Raw_Cache'
+MAX_AGE_DAYS = 90 # Entries stored longer ago than this are evicted
+MAX_SIZE_MB = 2048 # Least recently used entries are evicted above this compressed size
+MUTABLE_TTL_MINUTES = 60 # Exports for a day or month that is not over yet are refetched after this long
+
+class RawCache:
+    '''
+    Content-addressed cache of raw dashbox responses.
+    Bodies are stored gzipped under objects/ by their sha256, and refs/<serial>/<endpoint>/<date>.json points a
+    (unit serial, endpoint, date) key at a body. Exports for completed days and months never change and are
+    served until evicted; exports for the current day or month expire after MUTABLE_TTL_MINUTES.
+    '''
+    def __init__(self, path: str = CACHE_PATH, max_age_days: int = MAX_AGE_DAYS, max_size_mb: int = MAX_SIZE_MB):
+        self.path = path
+        self.max_age_days = max_age_days
+        self.max_size_mb = max_size_mb
+
+    def _ref_path(self, serial, endpoint, date) -> str:
+        return os.path.join(self.path, 'refs', str(serial), endpoint, f'{date}.json')
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.path, 'objects', digest[:2], f'{digest}.gz')
+
+    @staticmethod
+    def is_complete(endpoint: str, date: str) -> bool:
+        '''
+        True if the export covers a day or month that is over, so its contents can no longer change
+        '''
+        if endpoint == 'exportMonthly':
+            return date < datetime.now().strftime('%Y-%m')
+        return date < datetime.now().strftime('%Y-%m-%d')
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, serial, endpoint: str, date: str):
+        '''
+        Read a cached response body
+
+        param: serial: str: unit serial
+        param: endpoint: str: export endpoint (exportDaily, exportMonthly)
+        param: date: str: date or month of the export
+        return: bytes: cached body, None if there is no valid entry
+        '''
+        ref_path = self._ref_path(serial, endpoint, date)
+        try:
+            with open(ref_path, 'r') as f:
+                ref = json.load(f)
+            if not ref['complete'] and time.time() - ref['stored'] > MUTABLE_TTL_MINUTES * 60:
+                return None
+            with gzip.open(self._object_path(ref['sha256']), 'rb') as f:
+                body = f.read()
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, OSError, EOFError):
+            return None
+        if hashlib.sha256(body).hexdigest() != ref['sha256']:
+            print(f"{color.YELLOW}Cache entry {serial}/{endpoint}/{date} failed checksum, refetching{color.END}")
+            self.delete(serial, endpoint, date)
+            return None
+        # Record the access for least recently used eviction
+        os.utime(ref_path)
+        return body
+
+    def put(self, serial, endpoint: str, date: str, body: bytes):
+        '''
+        Store a response body
+
+        param: serial: str: unit serial
+        param: endpoint: str: export endpoint (exportDaily, exportMonthly)
+        param: date: str: date or month of the export
+        param: body: bytes: raw response body
+        '''
+        digest = hashlib.sha256(body).hexdigest()
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            self._write_atomic(object_path, gzip.compress(body))
+        ref = {
+            "sha256": digest,
+            "size": len(body),
+            "stored": time.time(),
+            "complete": self.is_complete(endpoint, date)
+        }
+        self._write_atomic(self._ref_path(serial, endpoint, date), json.dumps(ref).encode())
+
+    def delete(self, serial, endpoint: str, date: str):
+        try:
+            os.remove(self._ref_path(serial, endpoint, date))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        '''
+        Remove entries older than max_age_days, then least recently used entries until the cache fits in
+        max_size_mb, then bodies no entry points at
+        '''
+        refs = []
+        for root, _, files in os.walk(os.path.join(self.path, 'refs')):
+            for file in files:
+                if file.endswith('.json'):
+                    ref_path = os.path.join(root, file)
+                    try:
+                        with open(ref_path, 'r') as f:
+                            ref = json.load(f)
+                        refs.append((os.path.getmtime(ref_path), ref_path, ref))
+                    except (json.JSONDecodeError, OSError):
+                        os.remove(ref_path)
+        cutoff = time.time() - self.max_age_days * 86400
+        kept = []
+        for accessed, ref_path, ref in sorted(refs, key=lambda r: r[0]):
+            if ref.get('stored', 0) < cutoff:
+                os.remove(ref_path)
+            else:
+                kept.append((accessed, ref_path, ref))
+
+        objects = {}
+        for root, _, files in os.walk(os.path.join(self.path, 'objects')):
+            for file in files:
+                objects[file[:-len('.gz')]] = os.path.join(root, file)
+        referenced = {ref['sha256'] for _, _, ref in kept}
+        for digest in set(objects) - referenced:
+            os.remove(objects.pop(digest))
+
+        size = sum(os.path.getsize(path) for path in objects.values())
+        limit = self.max_size_mb * 1024 * 1024
+        # Oldest access first; a body is freed once no remaining entry shares it
+        remaining = Counter(ref['sha256'] for _, _, ref in kept)
+        for _, ref_path, ref in kept:
+            if size <= limit:
+                break
+            os.remove(ref_path)
+            remaining[ref['sha256']] -= 1
+            if remaining[ref['sha256']] == 0 and ref['sha256'] in objects:
+                size -= os.path.getsize(objects[ref['sha256']])
+                os.remove(objects.pop(ref['sha256']))
@@ -1,12 +1,18 @@
-from rules import check_limits, check_pulse, check_water_pulse
+import numpy as np
+import pandas as pd
+from log import Log
+from color import color
+from rules import check_limits, check_pulse, check_water_pulse, check_temperature, limit_flags, pulse_flags, water_pulse_flags, time_step_minutes
 
 class Channel:
-    def __init__(self, name:str, min_value:float, max_value:float, regex:str, check_func:callable=None):
+    def __init__(self, name:str, min_value:float, max_value:float, regex:str, check_func:callable=None, vector_func:callable=None):
         self.name = name
         self.min_value = min_value
         self.max_value = max_value
         self.regex = regex
         self.check_func = check_func
+        # Vectorized form of check_func (see rules.py), run by check_channels over all channels that share it
+        self.vector_func = vector_func
 
     def __str__(self):
         return f"Channel {self.name}"
@@ -22,45 +28,135 @@ class Channel:
         return errors, warnings
 
 channels = {
-    "A/C Watts": Channel("A/C Watts", 0, 3500, "A/C (Watts)$", check_limits),
-    "AHU Watts": Channel("AHU Watts", 0, 400, "AHU (Watts)$", check_pulse),
-    "Baseboard Heater 1 Watts": Channel("Baseboard Heater 1 Watts", 0, 2000, "Baseboard.*Heater.*1.*(Watts)$", check_limits),
-    "Baseboard Heater 2 Watts": Channel("Baseboard Heater 2 Watts", 0, 2000, "Baseboard.*Heater.*2.*(Watts)$", check_limits),
-    "Baseboard Heater 3 Watts": Channel("Baseboard Heater 3 Watts", 0, 2000, "Baseboard.*Heater.*3.*(Watts)$", check_limits),
-    "Bedroom Plugs Watts": Channel("Bedroom Plugs Watts", 0, 3000, "Bedroom.?Plugs.*(Watts)$", check_limits),
-    "Dishwasher Watts": Channel("Dishwasher Watts", 0, 1200, "Dishwasher.*(Watts)$", check_limits),
-    "Dryer (1) Watts": Channel("Dryer (1) Watts", 0, 3500, "Dryer.*1.*(Watts)$", check_limits),
-    "Dryer (2) Watts": Channel("Dryer (2) Watts", 0, 3500, "Dryer.*2.*(Watts)$", check_limits),
-    "Electrical Baseboard 1 Watts": Channel("Electrical Baseboard 1 Watts", 0, 2000, "Electrical.*Baseboard1.*(Watts)$", check_limits),
-    "Electrical Baseboard 2 Watts": Channel("Electrical Baseboard 2 Watts", 0, 2000, "Electrical.*Baseboard2.*(Watts)$", check_limits),
-    "Electrical Baseboard 3 Watts": Channel("Electrical Baseboard 3 Watts", 0, 2000, "Electrical.*Baseboard3.*(Watts)$", check_limits),
-    "Electrical Baseboard 4 Watts": Channel("Electrical Baseboard 4 Watts", 0, 2000, "Electrical.*Baseboard4.*(Watts)$", check_limits),
-    "Fridge Watts": Channel("Fridge Watts", 0, 627.2, "Fridge.*(Watts)$", check_pulse),
-    "Ground Level Plugs Watts": Channel("Ground Level Plugs Watts", 0, 3000, "Ground.*Level.*Plugs?.*(Watts)$", check_limits),
-    "HRV Watts": Channel("HRV Watts", 0, 500, "HRV.*(Watts)$", check_limits),
-    "Hot Water Tank 1 Watts": Channel("Hot Water Tank 1 Watts", 0, 4500, "Hot.*Water.*Tank.*1.*(Watts)$", check_limits),
-    "Hot Water Tank 2 Watts": Channel("Hot Water Tank 2 Watts", 0, 4500, "Hot.*Water.*Tank.*2.*(Watts)$", check_limits),
-    "Kitchen Counter Plugs Watts": Channel("Kitchen Counter Plugs Watts", 0, 3000, "Kitchen.*Counter.*Plug?.*(Watts)$", check_limits),
-    "Living Room Plugs Watts": Channel("Living Room Plugs Watts", 0, 3000, "Living.*Room.*Plugs?.*(Watts)$", check_limits),
-    "Main Electricity 1 Watts": Channel("Main Electricity 1 Watts", 0, 10000, "Main\\s*Electricity\\s*1\\s*(Watts)$", check_limits),
-    "Main Electricity 2 Watts": Channel("Main Electricity 2 Watts", 0, 10000, "Main\\s*Electricity\\s*2\\s*(Watts)$", check_limits),
-    "Main Electricity Gen Watts": Channel("Main Electricity Gen Watts", -10000, 10000, "Main\\s*Electricity\\s*Gen\\s*(Watts)$", check_limits),
-    "Main Electricity Gen Watts 1": Channel("Main Electricity Gen Watts 1", -10000, 10000, "Main\\s*Electricity\\s*Gen\\s*Watts.*1$", check_limits),
-    "Main Floor Plugs Watts": Channel("Main Floor Plugs Watts", 0, 3000, "Main.*Floor.*Plugs?.*(Watts)$", check_limits),
-    "Office Room Plugs Watts": Channel("Office Room Plugs Watts", 0, 3000, "Office.*Room.*Plugs?.*(Watts)$", check_limits),
-    "PV Generation 1 Watts": Channel("PV Generation 1 Watts", 0, 1500, "PV.*Generation.*1.*(Watts)$", check_limits),
-    "PV Generation 2 Watts": Channel("PV Generation 2 Watts", 0, 1500, "PV.*Generation.*2.*(Watts)$", check_limits),
-    "Range (1) Watts": Channel("Range (1) Watts", 0, 11300, "Range.*1.*(Watts)$", check_limits),
-    "Range (2) Watts": Channel("Range (2) Watts", 0, 11300, "Range.*2.*(Watts)$", check_limits),
-    "Second Floor Plugs Watts": Channel("Second Floor Plugs Watts", 0, 3000, "Second.*Floor.*Plugs?.*(Watts)$", check_limits),
-    "Tankless WaterHeater Watts": Channel("Tankless WaterHeater Watts", 0, 250, "Tankless.*WaterHeater.*(Watts)$", check_limits),
-    "Washing Machine Watts": Channel("Washing Machine Watts", 0, 1000, "Washing.*Machine.*(Watts)$", check_limits),
-    "Return Air Avg C": Channel("Return Air Avg C", 0.0001, 35, "Return.*Air.*Avg.*C$", check_limits),
-    "Cold Water Avg C": Channel("Cold Water Avg C", 0.0001, 27, "Cold.*Water.*Avg.*C$", check_limits),
-    "Heat Recovery Water Avg C": Channel("Heat Recovery Water Avg C", 0.0001, 45, "Heat.*C$", check_limits),
-    "Hot Water Avg C": Channel("Hot Water Avg C", 0.0001, 65, "Hot.*Water.*Avg.*C$", check_limits),
-    "Volts": Channel("Volts", 60, 180, "Volts", check_limits),
-    "Cold Water Cubic Meter": Channel("Cold Water Cubic Meter", 0, 25, "Cold.*Water.*Cubic.*(Meter)$", check_water_pulse),
-    "Hot Water Cubic Meter": Channel("Hot Water Cubic Meter", 0, 25, "Hot.*Water.*Cubic.*(Meter)$", check_water_pulse),
-    "Natural Gas": Channel("Natural Gas", 0, 25, "Natural.*Gas", check_pulse)
-}
\ No newline at end of file
+    "A/C Watts": Channel("A/C Watts", 0, 3500, "A/C (Watts)$", check_limits, limit_flags),
+    "AHU Watts": Channel("AHU Watts", 0, 400, "AHU (Watts)$", check_pulse, pulse_flags),
+    "Baseboard Heater 1 Watts": Channel("Baseboard Heater 1 Watts", 0, 2000, "Baseboard.*Heater.*1.*(Watts)$", check_limits, limit_flags),
+    "Baseboard Heater 2 Watts": Channel("Baseboard Heater 2 Watts", 0, 2000, "Baseboard.*Heater.*2.*(Watts)$", check_limits, limit_flags),
+    "Baseboard Heater 3 Watts": Channel("Baseboard Heater 3 Watts", 0, 2000, "Baseboard.*Heater.*3.*(Watts)$", check_limits, limit_flags),
+    "Bedroom Plugs Watts": Channel("Bedroom Plugs Watts", 0, 3000, "Bedroom.?Plugs.*(Watts)$", check_limits, limit_flags),
+    "Dishwasher Watts": Channel("Dishwasher Watts", 0, 1200, "Dishwasher.*(Watts)$", check_limits, limit_flags),
+    "Dryer (1) Watts": Channel("Dryer (1) Watts", 0, 3500, "Dryer.*1.*(Watts)$", check_limits, limit_flags),
+    "Dryer (2) Watts": Channel("Dryer (2) Watts", 0, 3500, "Dryer.*2.*(Watts)$", check_limits, limit_flags),
+    "Electrical Baseboard 1 Watts": Channel("Electrical Baseboard 1 Watts", 0, 2000, "Electrical.*Baseboard1.*(Watts)$", check_limits, limit_flags),
+    "Electrical Baseboard 2 Watts": Channel("Electrical Baseboard 2 Watts", 0, 2000, "Electrical.*Baseboard2.*(Watts)$", check_limits, limit_flags),
+    "Electrical Baseboard 3 Watts": Channel("Electrical Baseboard 3 Watts", 0, 2000, "Electrical.*Baseboard3.*(Watts)$", check_limits, limit_flags),
+    "Electrical Baseboard 4 Watts": Channel("Electrical Baseboard 4 Watts", 0, 2000, "Electrical.*Baseboard4.*(Watts)$", check_limits, limit_flags),
+    "Fridge Watts": Channel("Fridge Watts", 0, 627.2, "Fridge.*(Watts)$", check_pulse, pulse_flags),
+    "Ground Level Plugs Watts": Channel("Ground Level Plugs Watts", 0, 3000, "Ground.*Level.*Plugs?.*(Watts)$", check_limits, limit_flags),
+    "HRV Watts": Channel("HRV Watts", 0, 500, "HRV.*(Watts)$", check_limits, limit_flags),
+    "Hot Water Tank 1 Watts": Channel("Hot Water Tank 1 Watts", 0, 4500, "Hot.*Water.*Tank.*1.*(Watts)$", check_limits, limit_flags),
+    "Hot Water Tank 2 Watts": Channel("Hot Water Tank 2 Watts", 0, 4500, "Hot.*Water.*Tank.*2.*(Watts)$", check_limits, limit_flags),
+    "Kitchen Counter Plugs Watts": Channel("Kitchen Counter Plugs Watts", 0, 3000, "Kitchen.*Counter.*Plug?.*(Watts)$", check_limits, limit_flags),
+    "Living Room Plugs Watts": Channel("Living Room Plugs Watts", 0, 3000, "Living.*Room.*Plugs?.*(Watts)$", check_limits, limit_flags),
+    "Main Electricity 1 Watts": Channel("Main Electricity 1 Watts", 0, 10000, "Main\\s*Electricity\\s*1\\s*(Watts)$", check_limits, limit_flags),
+    "Main Electricity 2 Watts": Channel("Main Electricity 2 Watts", 0, 10000, "Main\\s*Electricity\\s*2\\s*(Watts)$", check_limits, limit_flags),
+    "Main Electricity Gen Watts": Channel("Main Electricity Gen Watts", -10000, 10000, "Main\\s*Electricity\\s*Gen\\s*(Watts)$", check_limits, limit_flags),
+    "Main Electricity Gen Watts 1": Channel("Main Electricity Gen Watts 1", -10000, 10000, "Main\\s*Electricity\\s*Gen\\s*Watts.*1$", check_limits, limit_flags),
+    "Main Floor Plugs Watts": Channel("Main Floor Plugs Watts", 0, 3000, "Main.*Floor.*Plugs?.*(Watts)$", check_limits, limit_flags),
+    "Office Room Plugs Watts": Channel("Office Room Plugs Watts", 0, 3000, "Office.*Room.*Plugs?.*(Watts)$", check_limits, limit_flags),
+    "PV Generation 1 Watts": Channel("PV Generation 1 Watts", 0, 1500, "PV.*Generation.*1.*(Watts)$", check_limits, limit_flags),
+    "PV Generation 2 Watts": Channel("PV Generation 2 Watts", 0, 1500, "PV.*Generation.*2.*(Watts)$", check_limits, limit_flags),
+    "Range (1) Watts": Channel("Range (1) Watts", 0, 11300, "Range.*1.*(Watts)$", check_limits, limit_flags),
+    "Range (2) Watts": Channel("Range (2) Watts", 0, 11300, "Range.*2.*(Watts)$", check_limits, limit_flags),
+    "Second Floor Plugs Watts": Channel("Second Floor Plugs Watts", 0, 3000, "Second.*Floor.*Plugs?.*(Watts)$", check_limits, limit_flags),
+    "Tankless WaterHeater Watts": Channel("Tankless WaterHeater Watts", 0, 250, "Tankless.*WaterHeater.*(Watts)$", check_limits, limit_flags),
+    "Washing Machine Watts": Channel("Washing Machine Watts", 0, 1000, "Washing.*Machine.*(Watts)$", check_limits, limit_flags),
+    "Return Air Avg C": Channel("Return Air Avg C", 0.0001, 35, "Return.*Air.*Avg.*C$", check_temperature),
+    "Cold Water Avg C": Channel("Cold Water Avg C", 0.0001, 27, "Cold.*Water.*Avg.*C$", check_temperature),
+    "Heat Recovery Water Avg C": Channel("Heat Recovery Water Avg C", 0.0001, 45, "Heat.*C$", check_temperature),
+    "Hot Water Avg C": Channel("Hot Water Avg C", 0.0001, 65, "Hot.*Water.*Avg.*C$", check_temperature),
+    "Volts": Channel("Volts", 60, 180, "Volts", check_limits, limit_flags),
+    "Cold Water Cubic Meter": Channel("Cold Water Cubic Meter", 0, 25, "Cold.*Water.*Cubic.*(Meter)$", check_water_pulse, water_pulse_flags),
+    "Hot Water Cubic Meter": Channel("Hot Water Cubic Meter", 0, 25, "Hot.*Water.*Cubic.*(Meter)$", check_water_pulse, water_pulse_flags),
+    "Natural Gas": Channel("Natural Gas", 0, 25, "Natural.*Gas", check_pulse, pulse_flags)
+}
+
+def is_summed(column: str) -> bool:
+    '''
+    Energy and pulse columns are per-minute amounts: they are summed into hours and their limits scale with the time step
+    '''
+    return column.endswith('kWh') or 'Cubic' in column
+
+def _flag_messages(data, column, limits, flags, j, unit_no):
+    '''
+    Messages for one column of vectorized flags, worded and ordered like check_limits, check_pulse and check_water_pulse
+    '''
+    errors, warnings = [], []
+    column_name = column.lstrip("0123456789- ")
+    rows = np.flatnonzero(flags["missing"][:, j] | flags["limit"][:, j])
+    if len(rows) > 0:
+        timestamps = data.iloc[:, 0]
+        raw = data[column].tolist()
+    for row in rows:
+        index = data.index[row]
+        if flags["missing"][row, j]:
+            Log.write(f"Unit {unit_no}: {timestamps.iat[row]} Index {index}: Missing data in {column_name}")
+            if flags["missing_count"][row, j] > 10:
+                errors.append(f"{timestamps.iat[row]} Multiple missing data in {column_name}")
+            else:
+                warnings.append(f"{timestamps.iat[row]} Index {index}: Missing data in {column_name}")
+        else:
+            message = f"{timestamps.iat[row]} Index {index}: {column_name} out of limits, Value: {raw[row]}, Limits: ({limits[0]}, {limits[1]})"
+            Log.write(f"Unit {unit_no}: {message}")
+            if flags["limit_count"][row, j] > 2:
+                errors.append(message)
+            else:
+                warnings.append(message)
+    if flags.get("inactive") is not None and flags["inactive"][j]:
+        print(f"{color.YELLOW}Unit {unit_no}: {column_name} no response - Possible Disconnection{color.END}")
+        Log.write(f"Unit {unit_no}: {column_name} no response - Possible Disconnection")
+        errors.append(f"{column_name} no response - Possible Disconnection")
+    return errors, warnings
+
+def check_channels(data, unit_no, names, bad_indices):
+    '''
+    Check several channels of one unit's data.
+    Channels with a vector_func are resolved to their columns once and each vector_func runs once over all of
+    its channels as a rows x channels array, with the limits broadcast across columns. Messages are built at
+    the end in channel order, the same as calling check_channel for each channel; channels without a
+    vector_func run their check_func. Limits of summed columns (kWh, Cubic) are per minute and are scaled
+    to the time step of the data, e.g. x60 for hourly data.
+
+    param: data: pd.DataFrame: data to check
+    param: unit_no: int: unit number used in messages
+    param: names: list[str]: channels to check
+    param: bad_indices: list: row labels to skip
+    return: tuple[list[str], list[str]]: errors and warnings
+    '''
+    skip = np.asarray(data.index.isin(bad_indices), dtype=bool)
+    step = time_step_minutes(data)
+    columns, limits, groups = {}, {}, {}
+    for name in names:
+        channel = channels[name]
+        matching = data.filter(regex=channel.regex).columns
+        if channel.vector_func is not None and len(matching) > 0:
+            columns[name] = matching[0]
+            scale = step if is_summed(matching[0]) else 1
+            limits[name] = (channel.min_value * scale, channel.max_value * scale)
+            groups.setdefault(channel.vector_func, []).append(name)
+    flags = {}
+    for vector_func, group in groups.items():
+        values = np.empty((len(data), len(group)), dtype=np.float64)
+        for j, name in enumerate(group):
+            values[:, j] = pd.to_numeric(data[columns[name]], errors='coerce').to_numpy(dtype=np.float64)
+        low = np.array([limits[name][0] for name in group], dtype=np.float64)
+        high = np.array([limits[name][1] for name in group], dtype=np.float64)
+        result = vector_func(values, low, high, skip)
+        for j, name in enumerate(group):
+            flags[name] = (result, j)
+
+    errors, warnings = [], []
+    for name in names:
+        channel = channels[name]
+        if channel.vector_func is None:
+            channel_errors, channel_warnings = channel.check_channel(data, unit_no, bad_indices)
+        elif name not in flags:
+            print(f"{color.RED}Unit {unit_no}: Column not found: {channel.regex}{color.END}")
+            Log.write(f"***Unit {unit_no}: Column not found: {channel.regex}")
+            channel_errors, channel_warnings = [f"Column not found: {channel.regex}"], []
+        else:
+            result, j = flags[name]
+            channel_errors, channel_warnings = _flag_messages(data, columns[name], limits[name], result, j, unit_no)
+        errors += channel_errors
+        warnings += channel_warnings
+    return errors, warnings
@@ -1,6 +1,8 @@
 import os
 import pandas as pd
 import unit
+from storage import is_csv
+from registry import UnitRegistry
 
 # combine pandas dataframe csv files
 # dir_path: directory path containing csv files
@@ -9,7 +11,7 @@ def combine(dir_path, output_path):
     # get all csv files
     unit_no = dir_path.rstrip('/').split(' ')[-1]
     files = os.listdir(dir_path)
-    files = [f for f in files if f.endswith('.csv')]
+    files = [f for f in files if is_csv(f)]
 
     # combine all csv files
     data = []
@@ -28,10 +30,7 @@ def combine(dir_path, output_path):
 # combine all csv files in all directories
 def combine_all():
     # get all directories
-
-    block_1 = [2804, 2806, 2808, 2810, 2812, 2814, 2816, 2818]
-    block_3 = [77, 78, 79, 80, 81, 82, 83, 84, 85, 86]
-    dirs = [f'UNIT {unit_no}' for unit_no in block_1 + block_3]
+    dirs = [f'UNIT {unit_no}' for unit_no in UnitRegistry.get().unit_numbers()]
 
     # combine all csv files in all directories
     for d in dirs:
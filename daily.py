@@ -2,29 +2,35 @@ TIMEOUT_SEC = 60
 import socket
 socket.setdefaulttimeout(TIMEOUT_SEC)
 import os
+import sys
+import queue
+import threading
 from unit import Unit
+from registry import UnitRegistry
 from alert import send_email
 from log import Log
-import json
 import datetime
 from color import color
+from metrics import Metrics
+from fleet import analyze_fleet, fleet_data
+from rollup import rollup_hour_data, summarize_minutes
+from qualitystore import QualityStore
+from monthfile import append_day
+from cache import RawCache
+from breaker import CircuitBreaker
+from storage import check_compression
 
 MAX_WARNINGS = 50
+PIPELINE_DEPTH = 2 # Downloaded units waiting to be checked, bounds memory to a few units' data
 
 def load_units(config_path: str) -> list[Unit]:
     '''
     Load unit config jsons from folder path
 
     param: config_path: str: path to the config file
-    return: list[Unit]: list of units
+    return: list[Unit]: list of units, raises ValueError if a config is invalid
     '''
-    units = []
-    for file in os.listdir(config_path):
-        if file.endswith('.json'):
-            with open(os.path.join(config_path, file), 'r') as f:
-                unit = json.load(f)
-                units.append(Unit(unit['unit_no'], unit['block'], unit['ip_address'], unit['port'], unit['serial'], unit['channels']))
-    return sorted(units)
+    return UnitRegistry.get(config_path).units()
 
 
 def delete_log():
@@ -36,14 +42,18 @@ def delete_log():
     except FileNotFoundError:
         pass
 
-def compile_email_body(units):
+def compile_email_body(units, fleet_issues: list[str] = None):
     '''
     Compile the email body from the list of errors
 
     param: errors: list[str]: list of errors
+    param: fleet_issues: list[str]: fleet level issues reported once for all units
     return: str: email body
     '''
-    body = f"Errors detected in the following unit(s):\n"
+    body = ""
+    if fleet_issues:
+        body += "Fleet issues:\n" + "\n".join(fleet_issues) + "\n\n"
+    body += f"Errors detected in the following unit(s):\n"
     error_units = set()
     for unit in units:
         if len(unit.errors) > 0 or len(unit.warnings) > MAX_WARNINGS:
@@ -82,44 +92,117 @@ def run_load_units():
     #     body = compile_email_body(units)
     #     send_email(subject=f"Maple West Data Quality Error(s) Detected", body=body, attachment=Log.get_path())
 
-def download_minute(save_files: bool = True):
+def _download_units(units: list[Unit], downloaded: queue.Queue, failures: list, project: bool, archive_raw: bool, breaker: CircuitBreaker):
+    '''
+    Pipeline producer: download and probe each unit, then hand it to the checker.
+    Units the circuit breaker has open are skipped after a short probe, their day is recorded in
+    failed_downloads.txt so monthly.py fetches it from the SD card once the unit is back.
+    Blocks while PIPELINE_DEPTH units are waiting, and always ends the queue with None.
+    '''
+    try:
+        for unit in units:
+            if not breaker.allow(unit.unit_no, unit.status_url()):
+                Log.record_failed_downloads(unit.unit_no, Unit.yesterday, unit.minute_url())
+                continue
+            unit.download_minute_data(project=project, archive_raw=archive_raw)
+            breaker.record(unit.unit_no, unit.data is not None)
+            if breaker.is_open(unit.unit_no):
+                # A failed retry of an offline unit is not reported again, and its status and space checks would time out too
+                unit.errors = []
+                continue
+            unit.check_status()
+            unit.check_space()
+            downloaded.put(unit)
+    except Exception as e:
+        failures.append(e)
+    finally:
+        downloaded.put(None)
+
+def download_minute(save_files: bool = True, metrics: bool = False, prometheus: bool = False, project: bool = False, archive_raw: bool = False, cache: bool = True, compression=None, memory: bool = False):
     delete_log()
+    check_compression(compression)
+    Unit.compression = compression
+    # Reruns for the same date read completed exports from Raw_Cache/ instead of the dashboxes
+    Unit.cache = RawCache() if cache else None
     yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
+    if metrics or memory:
+        Metrics.start("daily", yesterday.strftime('%Y-%m-%d'), memory)
     Log.write(f"{yesterday.strftime('%Y-%m-%d')}\n")
     errors = []
     warnings = []
     max_warnings = 0
-    units = load_units('config/')
+    with Metrics.stage("load_units"):
+        units = load_units('config/')
+    store = QualityStore()
+    breaker = CircuitBreaker()
+    # Unit N is checked while unit N+1 downloads
+    downloaded = queue.Queue(maxsize=PIPELINE_DEPTH)
+    failures = []
+    producer = threading.Thread(target=_download_units, args=(units, downloaded, failures, project, archive_raw, breaker), daemon=True)
+    producer.start()
+    while (unit := downloaded.get()) is not None:
+        unit.check_quality(save_files)
+        if unit.data is not None:
+            if save_files:
+                # The saved day is summarized once here, reports read the rollups instead of the minute files
+                with Metrics.stage("rollups", unit.unit_no):
+                    store.save_rollups(unit.unit_no, summarize_minutes(unit, unit.data))
+                # The month's combined file grows a day at a time, the monthly job only finalizes it
+                append_day(unit.unit_no, unit.saved_path)
+            # Only the fleet channels are kept for the fleet analysis
+            unit.data = fleet_data(unit.data)
+    producer.join()
+    if failures:
+        raise failures[0]
+    # Shared events are moved out of the individual units and reported once
+    with Metrics.stage("fleet"):
+        fleet_issues = analyze_fleet(units)
+    # Units that went offline or came back are reported once, skipped units add no errors of their own
+    fleet_issues += breaker.reports()
     for unit in units:
-        unit.download_minute_data()
-        unit.check_status()
-        unit.check_space()
-        unit_errors, unit_warnings = unit.check_quality(save_files)
-        errors += unit_errors
-        warnings += unit_warnings
-        max_warnings = max(max_warnings, len(unit_warnings))
+        errors += unit.errors
+        warnings += unit.warnings
+        max_warnings = max(max_warnings, len(unit.warnings))
     # if error len > 0, then send email and log to the user
-    if len(errors) > 0 or max_warnings > MAX_WARNINGS:
-        body = compile_email_body(units)
-        send_email(subject=f"Maple West System Error(s) Detected", body=body, attachment=Log.get_path())
-    else:
-        body = f"{yesterday.strftime('%Y-%m-%d')}\nSystems check passed for all units"
-        send_email(subject=f"Maple West Systems OK", body=body, attachment=Log.get_path())
+    with Metrics.stage("email"):
+        if len(errors) > 0 or max_warnings > MAX_WARNINGS or len(fleet_issues) > 0:
+            body = compile_email_body(units, fleet_issues)
+            send_email(subject=f"Maple West System Error(s) Detected", body=body, attachment=Log.get_path())
+        else:
+            body = f"{yesterday.strftime('%Y-%m-%d')}\nSystems check passed for all units"
+            send_email(subject=f"Maple West Systems OK", body=body, attachment=Log.get_path())
+    if Unit.cache is not None:
+        Unit.cache.evict()
+    Metrics.finish(prometheus)
 
-def download_hour(save_files: bool = True):
+def download_hour(save_files: bool = True, metrics: bool = False, prometheus: bool = False, cache: bool = True):
+    Unit.cache = RawCache() if cache else None
+    if metrics:
+        Metrics.start("hourly")
     Log.write("--------------- HOURLY DATA ---------------\n")
     units = load_units('config/')
     for unit in units:
-        unit.download_hour_data()
+        # Hourly data is rolled up from Minute_Data, the dashbox export is only fetched for missing hours
+        rollup_hour_data(unit)
         unit.check_quality(save_files)
+    Metrics.finish(prometheus)
     return
 
-def main():
+def main(metrics: bool = False, prometheus: bool = False, project: bool = False, archive_raw: bool = False, cache: bool = True, compression=None, memory: bool = False):
     # download_all() ### Disabled for now until service account has access to Maple West Data shared drive
     # delete_data_folder()
-    download_minute(save_files=True)
+    download_minute(save_files=True, metrics=metrics, prometheus=prometheus, project=project, archive_raw=archive_raw, cache=cache, compression=compression, memory=memory)
 
 if __name__ == "__main__":
-    main()
+    # --metrics writes Logs/<date>_daily_metrics.json, --prometheus also writes a textfile for node_exporter
+    # --project keeps only checked columns (saved Minute_Data too), --archive-raw keeps the full export in Raw_Data/
+    # --no-cache always downloads from the dashboxes instead of reusing Raw_Cache/
+    # --compress gzip|zstd saves Minute_Data as .csv.gz / .csv.zst
+    # --memory adds per-stage peak memory and the top allocation sites to the metrics, the run is slower
+    main(metrics='--metrics' in sys.argv or '--prometheus' in sys.argv, prometheus='--prometheus' in sys.argv,
+         project='--project' in sys.argv or '--archive-raw' in sys.argv, archive_raw='--archive-raw' in sys.argv,
+         cache='--no-cache' not in sys.argv,
+         compression=sys.argv[sys.argv.index('--compress') + 1] if '--compress' in sys.argv else None,
+         memory='--memory' in sys.argv)
     # run_download_units(save_files=True)
     # run_load_units()
@@ -0,0 +1,61 @@
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+CONNECT_TIMEOUT = 5 # Seconds to open a connection, a dashbox that is down fails fast
+READ_TIMEOUT = 60 # Seconds to wait between bytes of a response, exports can be slow to generate
+RETRIES = 2 # Extra attempts after a connection error, timeout or 5xx response
+BACKOFF_SEC = 1.0 # Base delay before a retry, doubled for each attempt and jittered
+POOL_SIZE = 4 # Keep-alive connections kept per dashbox
+RETRY_STATUS = {500, 502, 503, 504}
+
+_session = None
+_lock = threading.Lock()
+
+def session() -> requests.Session:
+    '''
+    Shared session for all dashbox traffic.
+    Connections are pooled and kept alive per host, so repeated requests to the same ip_address:port
+    (export, status, space) reuse one TCP connection.
+    '''
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=64, pool_maxsize=POOL_SIZE, max_retries=0)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        return _session
+
+def get(url: str, connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT, retries: int = RETRIES, stream: bool = False) -> requests.Response:
+    '''
+    GET a dashbox url, retrying connection errors, timeouts and 5xx responses with jittered exponential backoff
+
+    param: url: str: url to get
+    param: connect_timeout: float: seconds to open the connection
+    param: read_timeout: float: seconds to wait for data
+    param: retries: int: extra attempts after the first
+    param: stream: bool: do not read the body before returning
+    return: requests.Response: successful response, raises requests.RequestException after the last attempt
+    '''
+    for attempt in range(retries + 1):
+        try:
+            response = session().get(url, timeout=(connect_timeout, read_timeout), stream=stream)
+            if response.status_code in RETRY_STATUS and attempt < retries:
+                response.close()
+            else:
+                response.raise_for_status()
+                return response
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        time.sleep(BACKOFF_SEC * 2 ** attempt * random.uniform(0.5, 1.5))
+
+def fetch(url: str, **kwargs) -> bytes:
+    '''
+    Fetch the decoded response body of a dashbox url, see get for the arguments
+    '''
+    return get(url, **kwargs).content
@@ -0,0 +1,175 @@
+import re
+import warnings
+import numpy as np
+import pandas as pd
+from channels import channels
+from log import Log
+from color import color
+
+# Channels that are comparable between units; power channels depend on each household and are not compared
+FLEET_CHANNELS = ["Volts", "Cold Water Avg C", "Hot Water Avg C", "Return Air Avg C"]
+FLEET_FRACTION = 0.5 # Share of a block's reporting units out of limits at the same minute to call it a fleet event
+MIN_FLEET_UNITS = 3 # Fewest units out of limits together for a fleet event
+DRIFT_MADS = 5 # A unit whose median deviation from the block exceeds this many MADs is drifting
+DRIFT_MIN_SCALE = 0.02 # Floor for the MAD, as a fraction of the channel's range
+LIMIT_MESSAGE_REGEX = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) Index \d+: (.+?) out of limits')
+
+def fleet_data(data: pd.DataFrame, channel_names: list[str] = FLEET_CHANNELS) -> pd.DataFrame:
+    '''
+    Keep only the timestamp column and the columns of the fleet channels, as float32.
+    Used to release a unit's full minute data once it has been checked and saved.
+
+    param: data: pd.DataFrame: checked minute data with the timestamp in the first column
+    return: pd.DataFrame: the columns build_fleet_array reads
+    '''
+    keep = [data.columns[0]]
+    for channel in channel_names:
+        columns = data.columns[1:][data.columns[1:].str.contains(channels[channel].regex, regex=True)]
+        if len(columns) > 0 and columns[0] not in keep:
+            keep.append(columns[0])
+    trimmed = data.loc[:, ~data.columns.duplicated()][keep]
+    trimmed[keep[1:]] = trimmed[keep[1:]].apply(pd.to_numeric, errors='coerce').astype(np.float32)
+    return trimmed
+
+def build_fleet_array(units: list, channel_names: list[str] = FLEET_CHANNELS):
+    '''
+    Align the minute data of all units into one array
+
+    param: units: list[Unit]: units with checked data loaded
+    param: channel_names: list[str]: channels to include
+    return: tuple[np.ndarray, pd.DatetimeIndex, list[Unit]]: (unit x time x channel) float32 array with NaN
+            where a unit has no data or the channel is disabled, the shared time index and the units in array order
+    '''
+    units = [unit for unit in units if unit.data is not None and not unit.data.empty]
+    if not units:
+        return np.empty((0, 0, len(channel_names)), dtype=np.float32), pd.DatetimeIndex([]), []
+    times = [pd.to_datetime(unit.data.iloc[:, 0], errors='coerce') for unit in units]
+    index = pd.date_range(min(t.min() for t in times), max(t.max() for t in times), freq='min')
+    array = np.full((len(units), len(index), len(channel_names)), np.nan, dtype=np.float32)
+    for i, (unit, unit_times) in enumerate(zip(units, times)):
+        positions = index.get_indexer(unit_times)
+        valid = positions >= 0
+        for j, channel in enumerate(channel_names):
+            if not unit.channels.get(channel, False):
+                continue
+            columns = unit.data.filter(regex=channels[channel].regex).columns
+            if len(columns) == 0:
+                continue
+            values = pd.to_numeric(unit.data[columns[0]], errors='coerce').to_numpy(dtype=np.float32)
+            array[i, positions[valid], j] = values[valid]
+    return array, index, units
+
+def _intervals(mask: np.ndarray):
+    '''
+    Start and end positions of each run of True in a 1-D mask
+    '''
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(edges[::2], edges[1::2] - 1))
+
+def find_shared_events(array, index, units, channel_names: list[str] = FLEET_CHANNELS):
+    '''
+    Find minutes where most units of a block are out of limits on the same channel at once
+
+    return: list[dict]: one entry per block, channel and contiguous interval
+    '''
+    mins = np.array([channels[channel].min_value for channel in channel_names], dtype=np.float32)
+    maxs = np.array([channels[channel].max_value for channel in channel_names], dtype=np.float32)
+    with np.errstate(invalid='ignore'):
+        out_of_limits = (array < mins) | (array > maxs)
+    reporting = ~np.isnan(array)
+    events = []
+    blocks = np.array([unit.block for unit in units])
+    for block in np.unique(blocks):
+        in_block = blocks == block
+        counts = out_of_limits[in_block].sum(axis=0)
+        totals = reporting[in_block].sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            shared = (counts >= MIN_FLEET_UNITS) & (counts >= FLEET_FRACTION * totals)
+        for j, channel in enumerate(channel_names):
+            for start, end in _intervals(shared[:, j]):
+                affected = out_of_limits[in_block, start:end + 1, j].any(axis=1)
+                events.append({
+                    "block": int(block),
+                    "channel": channel,
+                    "start": index[start],
+                    "end": index[end],
+                    "units": [units[i].unit_no for i, hit in zip(np.flatnonzero(in_block), affected) if hit],
+                    "reporting": int(totals[start:end + 1, j].max())
+                })
+    return events
+
+def find_drifting_units(array, units, channel_names: list[str] = FLEET_CHANNELS):
+    '''
+    Find units whose channel sits far from the rest of their block over the whole period
+
+    return: list[dict]: one entry per drifting unit and channel
+    '''
+    drifting = []
+    blocks = np.array([unit.block for unit in units])
+    for block in np.unique(blocks):
+        in_block = np.flatnonzero(blocks == block)
+        if len(in_block) < MIN_FLEET_UNITS:
+            continue
+        block_array = array[in_block]
+        with warnings.catch_warnings():
+            # All-NaN slices (disabled channels, missing minutes) are expected
+            warnings.simplefilter('ignore', RuntimeWarning)
+            # Per-minute block median and each unit's typical deviation from it
+            median = np.nanmedian(block_array, axis=0)
+            deviation = np.nanmedian(block_array - median, axis=1)
+            centre = np.nanmedian(deviation, axis=0)
+            mad = np.nanmedian(np.abs(deviation - centre), axis=0)
+        for j, channel in enumerate(channel_names):
+            scale = max(float(mad[j]) if not np.isnan(mad[j]) else 0, DRIFT_MIN_SCALE * (channels[channel].max_value - channels[channel].min_value))
+            for k, unit_index in enumerate(in_block):
+                offset = deviation[k, j]
+                if not np.isnan(offset) and abs(offset - centre[j]) > DRIFT_MADS * scale:
+                    drifting.append({"unit": units[unit_index].unit_no, "block": int(block), "channel": channel, "offset": round(float(offset - centre[j]), 2)})
+    return drifting
+
+def _reclassify(units, events):
+    '''
+    Remove per-unit out-of-limits messages covered by a fleet event so each event is reported once
+    '''
+    for unit in units:
+        for attribute in ["errors", "warnings"]:
+            kept = []
+            for message in getattr(unit, attribute):
+                match = LIMIT_MESSAGE_REGEX.match(message)
+                covered = False
+                if match:
+                    timestamp = pd.Timestamp(match.group(1))
+                    for event in events:
+                        if (unit.unit_no in event["units"] and event["start"] <= timestamp <= event["end"]
+                                and re.search(channels[event["channel"]].regex, match.group(2))):
+                            covered = True
+                            break
+                if not covered:
+                    kept.append(message)
+            setattr(unit, attribute, kept)
+
+def analyze_fleet(units: list, channel_names: list[str] = FLEET_CHANNELS) -> list[str]:
+    '''
+    Compare all units against their block in one vectorized pass. Out-of-limit minutes shared by most of a block
+    are reported once as a fleet event and removed from the individual units, and units drifting away from their
+    neighbours are reported.
+
+    param: units: list[Unit]: units after check_quality
+    return: list[str]: fleet level messages
+    '''
+    array, index, present = build_fleet_array(units, channel_names)
+    if len(present) < MIN_FLEET_UNITS:
+        return []
+    events = find_shared_events(array, index, present, channel_names)
+    _reclassify(present, events)
+    messages = []
+    for event in events:
+        messages.append(f"Block {event['block']}: {event['channel']} out of limits on {len(event['units'])}/{event['reporting']} units "
+                        f"from {event['start']} to {event['end']} - Possible site-wide event, units {event['units']}")
+    for drift in find_drifting_units(array, present, channel_names):
+        messages.append(f"Unit {drift['unit']}: {drift['channel']} drifting {drift['offset']} from Block {drift['block']} median")
+    for message in messages:
+        print(f"{color.YELLOW}Fleet: {message}{color.END}")
+        Log.write(f"Fleet: {message}")
+    return messages
@@ -0,0 +1,135 @@
+import os
+import sys
+import pandas as pd
+from datetime import datetime, timedelta
+from unit import Unit
+from log import Log
+from color import color
+from metrics import Metrics
+from rules import check_missing_rows
+from registry import UnitRegistry
+from qualitystore import QualityStore
+from rollup import summarize_minutes
+from monthfile import replace_day
+from storage import is_csv, csv_stem, csv_extension
+
+MINUTE_PATH = './Minute_Data'
+LOOKBACK_DAYS = 14 # Days before yesterday that are checked for gaps, older holes are left alone
+
+def missing_minutes(data: pd.DataFrame, day: str) -> pd.DatetimeIndex:
+    '''
+    Minutes of a day that have no row in a saved minute file.
+    Saved files have the full minute grid in the first column and the dashbox timestamp in the second,
+    which is empty for the rows check_missing_rows added; minutes before the first or after the last
+    downloaded row are not in the file at all.
+
+    param: data: pd.DataFrame: saved minute file
+    param: day: str: day of the file in YYYY-MM-DD format
+    return: pd.DatetimeIndex: missing minutes
+    '''
+    expected = pd.date_range(day, periods=1440, freq='min')
+    if data.empty:
+        return expected
+    present = pd.to_datetime(data.iloc[:, 0], errors='coerce')[data.iloc[:, 1].notna().to_numpy()]
+    return expected.difference(pd.DatetimeIndex(present.dropna()))
+
+def gap_days(unit: Unit, start: str, end: str, store: QualityStore, minute_path: str = MINUTE_PATH) -> list:
+    '''
+    Saved days of a unit between start and end (inclusive) that may have missing minutes.
+    Days with rollups are only candidates if a channel is missing minutes, days without rollups are
+    always candidates, so only those files are read.
+
+    return: list[tuple[str, str]]: (day, path) pairs
+    '''
+    unit_dir = os.path.join(minute_path, f'UNIT {unit.unit_no}')
+    if not os.path.isdir(unit_dir):
+        return []
+    rollups = store.load_rollups(unit.unit_no, 'day', start, end, channels=list(unit.plan))
+    complete = set(rollups.groupby('period')['missing'].max().loc[lambda missing: missing == 0].index)
+    days = []
+    for file in sorted(os.listdir(unit_dir)):
+        day = csv_stem(file).split('_')[-1] if is_csv(file) else None
+        if day is not None and start <= day <= end and day not in complete:
+            days.append((day, os.path.join(unit_dir, file)))
+    return days
+
+def fill_day(unit: Unit, day: str, path: str, store: QualityStore) -> int:
+    '''
+    Download a day again and merge in only the minutes missing from its saved file.
+    Rows already saved are kept as they are. The file is rewritten in place and the day's rollups refreshed.
+
+    return: int: number of minutes filled
+    '''
+    with Metrics.stage("load_data", unit.unit_no):
+        saved = pd.read_csv(path)
+    missing = missing_minutes(saved, day)
+    if missing.empty:
+        return 0
+    print(f"Unit {unit.unit_no}: {len(missing)} minutes missing on {day}, downloading again")
+    unit.download_minute_data(day, refresh=True)
+    if unit.data is None:
+        return 0
+    fresh = unit.data
+    timestamps = pd.to_datetime(fresh.iloc[:, 0], errors='coerce')
+    fresh = fresh[timestamps.isin(missing).to_numpy()]
+    if fresh.empty:
+        Log.write(f"Unit {unit.unit_no}: Dashbox has none of the {len(missing)} missing minutes for {day}")
+        print(f"{color.YELLOW}Unit {unit.unit_no}: Dashbox has none of the {len(missing)} missing minutes for {day}{color.END}")
+        return 0
+
+    # Drop the grid column so the saved rows have the export's columns again, then line the new rows up with them
+    rows = saved.drop(columns=saved.columns[0])[saved.iloc[:, 1].notna().to_numpy()]
+    rows.columns = fresh.columns[:1].append(rows.columns[1:])
+    rows[rows.columns[0]] = pd.to_datetime(rows[rows.columns[0]], errors='coerce')
+    fresh = fresh.reindex(columns=rows.columns)
+    with Metrics.stage("check_missing_rows", unit.unit_no):
+        merged, _, _, _ = check_missing_rows(pd.concat([rows, fresh], ignore_index=True), unit.unit_no)
+    merged = merged.drop(columns='Timestamp', errors='ignore')
+
+    # Written next to the file under a temporary name with the same extension, so pandas compresses it the same way
+    tmp_path = os.path.join(os.path.dirname(path), f'.gapfill_{os.getpid()}{csv_extension(path)}')
+    with Metrics.stage("save", unit.unit_no):
+        merged.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    # The month's combined file takes the rewritten day in place of the old one
+    replace_day(unit.unit_no, path)
+    summary = merged[merged.iloc[:, 0].astype(str).str.startswith(day)]
+    with Metrics.stage("summarize", unit.unit_no):
+        store.save_rollups(unit.unit_no, summarize_minutes(unit, unit.project_data(summary)))
+    Log.write(f"Unit {unit.unit_no}: Filled {len(fresh)} of {len(missing)} missing minutes on {day}")
+    print(f"{color.GREEN}Unit {unit.unit_no}: Filled {len(fresh)} of {len(missing)} missing minutes on {day}{color.END}")
+    Metrics.add("minutes_filled", len(fresh), unit.unit_no)
+    return len(fresh)
+
+def fill_gaps(units: list, start: str, end: str, store: QualityStore = None, minute_path: str = MINUTE_PATH) -> dict:
+    '''
+    Fill missing minutes of every unit between start and end (inclusive)
+
+    return: dict[int, int]: unit number -> minutes filled
+    '''
+    store = store or QualityStore()
+    filled = {}
+    for unit in units:
+        filled[unit.unit_no] = 0
+        for day, path in gap_days(unit, start, end, store, minute_path):
+            try:
+                filled[unit.unit_no] += fill_day(unit, day, path, store)
+            except Exception as e:
+                Log.write(f"Unit {unit.unit_no}: Gap fill failed for {day}: {str(e)}")
+                print(f"{color.RED}Unit {unit.unit_no}: Gap fill failed for {day}: {str(e)}{color.END}")
+    return filled
+
+def main(days: int = LOOKBACK_DAYS, metrics: bool = False, prometheus: bool = False):
+    if metrics:
+        Metrics.start("gapfill")
+    end = Unit.yesterday
+    start = (datetime.strptime(end, '%Y-%m-%d') - timedelta(days=days)).strftime('%Y-%m-%d')
+    filled = fill_gaps(UnitRegistry.get().units(), start, end)
+    print(f"Filled {sum(filled.values())} missing minutes between {start} and {end}")
+    if metrics:
+        Metrics.finish(prometheus)
+
+if __name__ == "__main__":
+    # python gapfill.py [--days N] [--metrics]
+    main(days=int(sys.argv[sys.argv.index('--days') + 1]) if '--days' in sys.argv else LOOKBACK_DAYS,
+         metrics='--metrics' in sys.argv or '--prometheus' in sys.argv, prometheus='--prometheus' in sys.argv)
@@ -0,0 +1,82 @@
+import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from unit import Unit, parse_status, parse_space, is_float
+from color import color
+from registry import UnitRegistry
+import dashbox
+
+PROBE_TIMEOUT = 3 # Seconds to connect and to wait for the page, a unit slower than this counts as down
+MAX_WORKERS = 128 # Probes run at once, fleets up to this size finish in about one PROBE_TIMEOUT
+
+def probe(unit: Unit, timeout: float = PROBE_TIMEOUT) -> dict:
+    '''
+    Fetch a unit's getmainwatts page once, without retries
+
+    param: unit: Unit: unit to probe
+    param: timeout: float: connect and read timeout in seconds
+    return: dict: unit_no, address, up, light, space_gb, latency_ms and error
+    '''
+    result = {"unit_no": unit.unit_no, "address": f"{unit.ip_address}:{unit.port}", "up": False,
+              "light": None, "space_gb": None, "latency_ms": None, "error": None}
+    start = time.perf_counter()
+    try:
+        html = dashbox.fetch(unit.status_url(), connect_timeout=timeout, read_timeout=timeout, retries=0).decode("utf-8")
+        result["latency_ms"] = round((time.perf_counter() - start) * 1000)
+        result["up"] = True
+        src = parse_status(html)
+        result["light"] = None if src is None else ('green' if 'green' in src else src.split('/')[-1].split('.')[0])
+        space = parse_space(html)
+        result["space_gb"] = float(space) if is_float(space) else space
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {str(e)}"
+    return result
+
+def sweep(units: list, timeout: float = PROBE_TIMEOUT) -> list[dict]:
+    '''
+    Probe all units in parallel. Units that have not answered within about one timeout are reported as
+    timed out, so the sweep does not wait on a slow one.
+
+    return: list[dict]: probe results in unit order
+    '''
+    if not units:
+        return []
+    pool = ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(units)))
+    futures = {pool.submit(probe, unit, timeout): unit for unit in units}
+    # Connect and read timeouts are separate, so allow a little more than one before giving up on a probe
+    done, _ = wait(futures, timeout=timeout * 2 + 1)
+    pool.shutdown(wait=False, cancel_futures=True)
+    results = []
+    for future, unit in futures.items():
+        if future in done:
+            results.append(future.result())
+        else:
+            results.append({"unit_no": unit.unit_no, "address": f"{unit.ip_address}:{unit.port}", "up": False,
+                            "light": None, "space_gb": None, "latency_ms": None, "error": "timed out"})
+    return sorted(results, key=lambda result: result["unit_no"])
+
+def print_table(results: list[dict]):
+    print(f"{'Unit':>6}  {'Address':<22}  {'Light':<8}  {'SD GB':>6}  {'ms':>6}")
+    for result in results:
+        if not result["up"]:
+            print(f"{color.RED}{result['unit_no']:>6}  {result['address']:<22}  {'DOWN':<8}  {'':>6}  {'':>6}  {result['error']}{color.END}")
+            continue
+        line = f"{result['unit_no']:>6}  {result['address']:<22}  {str(result['light']):<8}  {str(result['space_gb'] if result['space_gb'] is not None else ''):>6}  {result['latency_ms']:>6}"
+        print(f"{color.GREEN}{line}{color.END}" if result["light"] == 'green' else f"{color.YELLOW}{line}{color.END}")
+    up = sum(result["up"] for result in results)
+    print(f"{up}/{len(results)} dashboxes up")
+
+if __name__ == "__main__":
+    # python health.py [--json] [--timeout SECONDS] [--units 77,78]
+    timeout = float(sys.argv[sys.argv.index('--timeout') + 1]) if '--timeout' in sys.argv else PROBE_TIMEOUT
+    registry = UnitRegistry.get()
+    if '--units' in sys.argv:
+        units = [registry.unit(int(unit_no)) for unit_no in sys.argv[sys.argv.index('--units') + 1].split(',')]
+    else:
+        units = registry.units()
+    results = sweep(units, timeout)
+    if '--json' in sys.argv:
+        print(json.dumps(results, indent=4))
+    else:
+        print_table(results)
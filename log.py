@@ -8,7 +8,15 @@ class Log:
     yesterday = (datetime.now() - pd.Timedelta(days=1)).strftime('%Y-%m-%d')
 
     @staticmethod
-    def write(message, date=yesterday):
+    def refresh_dates():
+        '''
+        Recompute yesterday, for processes that run across midnight
+        '''
+        Log.yesterday = (datetime.now() - pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+
+    @staticmethod
+    def write(message, date=None):
+        date = date or Log.yesterday
         if not os.path.exists(Log.path):
             os.makedirs(Log.path)
         path = Log.path + date + '.txt'
@@ -16,7 +24,8 @@ class Log:
             file.write(message + '\n')
     
     @staticmethod
-    def get_path(date=yesterday):
+    def get_path(date=None):
+        date = date or Log.yesterday
         path = Log.path + date + '.txt'
         return path
     
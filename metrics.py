@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import resource
+import threading
+import tracemalloc
+from datetime import datetime
+from contextlib import contextmanager
+from log import Log
+
+TRACE_FRAMES = 1 # Stack frames kept per traced allocation, more shows call paths but slows the run further
+SAMPLE_SEC = 0.05 # How often RSS and traced memory are sampled while memory profiling, shorter spikes can be missed
+TOP_SITES = 10 # Allocation sites reported in the summary
+MEMORY_BUDGETS_MB = {} # Run name -> RSS budget, e.g. {'monthly': 2048}; a run over its budget is logged and flagged
+
+class Metrics:
+    '''
+    Per-stage timing and counters for the daily, monthly and quality runs.
+    Disabled by default; every call is a no-op until Metrics.start() is called.
+    With memory profiling, tracemalloc and a sampler thread also record each stage's peak traced and resident
+    memory, and the sampler keeps the top allocation sites from the moment traced memory was highest. Peaks
+    are process-wide, so overlapping stages (the daily pipeline's download and check threads) each see the
+    other's allocations.
+    '''
+    path = Log.path
+    enabled = False
+    memory = False
+    run = None
+    stages = []
+    counters = {}
+    top_allocations = None
+    _start_time = 0
+    _lock = threading.Lock() # Counters are updated from the daily pipeline's download and check threads
+    _open = [] # Memory peaks of the run and of the stages in progress
+    _sampler_stop = None
+    _sampler = None
+    _snapshot_traced = 0 # Traced bytes when top_allocations was taken
+
+    @staticmethod
+    def start(name: str, date=None, memory: bool = False):
+        '''
+        Enable instrumentation for a run
+
+        param: name: str: name of the run (daily, hourly, monthly, quality)
+        param: date: str: date the run is for, used in the summary file name, defaults to yesterday
+        param: memory: bool: also profile memory with tracemalloc and RSS sampling, slows the run down
+        '''
+        date = date or Log.yesterday
+        Metrics.enabled = True
+        Metrics.run = {"name": name, "date": date, "started": datetime.now().isoformat(timespec='seconds')}
+        Metrics.stages = []
+        Metrics.counters = {}
+        Metrics.memory = memory
+        Metrics.top_allocations = None
+        Metrics._snapshot_traced = 0
+        if memory:
+            tracemalloc.start(TRACE_FRAMES)
+            Metrics._open = [{"stage": None, "unit": None, "traced": 0, "rss": Metrics.rss_mb()}]
+            Metrics._sampler_stop = threading.Event()
+            Metrics._sampler = threading.Thread(target=Metrics._sample, args=(Metrics._sampler_stop,), daemon=True)
+            Metrics._sampler.start()
+        Metrics._start_time = time.perf_counter()
+
+    @staticmethod
+    def peak_rss_mb() -> float:
+        # ru_maxrss is reported in kilobytes on Linux
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    @staticmethod
+    def rss_mb() -> float:
+        '''
+        Current resident memory, falls back to the peak where /proc is not available
+        '''
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576, 1)
+        except (OSError, ValueError):
+            return Metrics.peak_rss_mb()
+
+    @staticmethod
+    def _sample(stop: threading.Event):
+        '''
+        Sampler thread: update the RSS peaks of the open stages, and snapshot the allocation sites whenever
+        traced memory reaches a new high, so transient peaks freed before their stage ends are attributed too
+        '''
+        while not stop.wait(SAMPLE_SEC):
+            rss = Metrics.rss_mb()
+            traced = tracemalloc.get_traced_memory()[0]
+            with Metrics._lock:
+                for peaks in Metrics._open:
+                    peaks["rss"] = max(peaks["rss"], rss)
+                innermost = Metrics._open[-1]
+            # Snapshots are slow on a large heap, only take one when memory is well above the last
+            if traced > Metrics._snapshot_traced * 1.1:
+                Metrics._snapshot(innermost["stage"], innermost["unit"], traced)
+
+    @staticmethod
+    def _fold_peaks():
+        '''
+        Add the traced peak since the last call to every open stage, then start a new peak
+        '''
+        with Metrics._lock:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+            rss = Metrics.rss_mb()
+            for peaks in Metrics._open:
+                peaks["traced"] = max(peaks["traced"], peak)
+                peaks["rss"] = max(peaks["rss"], rss)
+
+    @staticmethod
+    def _snapshot(name: str, unit_no, traced: int):
+        '''
+        Keep the top allocation sites while traced memory is at its highest so far
+
+        param: name: str: innermost stage running when the snapshot is taken, None outside any stage
+        param: unit_no: int: unit of that stage
+        param: traced: int: traced bytes when the snapshot was triggered
+        '''
+        Metrics._snapshot_traced = traced
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        Metrics.top_allocations = {
+            "stage": name,
+            "unit": unit_no,
+            "traced_mb": round(traced / 1048576, 1),
+            "sites": [{"site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", "mb": round(stat.size / 1048576, 2), "blocks": stat.count}
+                      for stat in snapshot.statistics('lineno')[:TOP_SITES]]
+        }
+
+    @staticmethod
+    @contextmanager
+    def stage(name: str, unit_no=None):
+        '''
+        Time a stage of the run, optionally for a single unit
+
+        param: name: str: stage name (download, parse, check_energy, save, email, ...)
+        param: unit_no: int: unit the stage ran for, None for run-wide stages
+        '''
+        if not Metrics.enabled:
+            yield
+            return
+        peaks = None
+        if Metrics.memory:
+            Metrics._fold_peaks()
+            traced = tracemalloc.get_traced_memory()[0]
+            peaks = {"stage": name, "unit": unit_no, "traced": traced, "rss": Metrics.rss_mb(), "start": traced}
+            with Metrics._lock:
+                Metrics._open.append(peaks)
+        start = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except Exception:
+            ok = False
+            raise
+        finally:
+            record = {
+                "stage": name,
+                "unit": unit_no,
+                "seconds": round(time.perf_counter() - start, 4),
+                "peak_rss_mb": Metrics.peak_rss_mb(),
+                "ok": ok
+            }
+            if peaks is not None:
+                Metrics._fold_peaks()
+                with Metrics._lock:
+                    Metrics._open = [open_peaks for open_peaks in Metrics._open if open_peaks is not peaks]
+                traced = tracemalloc.get_traced_memory()[0]
+                record.update({
+                    "traced_peak_mb": round(peaks["traced"] / 1048576, 1),
+                    "traced_retained_mb": round((traced - peaks["start"]) / 1048576, 1),
+                    "stage_rss_peak_mb": peaks["rss"]
+                })
+            Metrics.stages.append(record)
+
+    @staticmethod
+    def add(counter: str, value, unit_no=None):
+        '''
+        Add to a counter (bytes_downloaded, rows_parsed, rows_checked, issues_emitted)
+
+        param: counter: str: counter name
+        param: value: int: amount to add
+        param: unit_no: int: unit the counter belongs to, None for run-wide counters
+        '''
+        if not Metrics.enabled:
+            return
+        key = str(unit_no) if unit_no is not None else "all"
+        with Metrics._lock:
+            unit_counters = Metrics.counters.setdefault(key, {})
+            unit_counters[counter] = unit_counters.get(counter, 0) + value
+
+    @staticmethod
+    def summary() -> dict:
+        totals = {}
+        for unit_counters in Metrics.counters.values():
+            for counter, value in unit_counters.items():
+                totals[counter] = totals.get(counter, 0) + value
+        stage_totals = {}
+        for stage in Metrics.stages:
+            stage_totals[stage["stage"]] = round(stage_totals.get(stage["stage"], 0) + stage["seconds"], 4)
+        summary = {
+            **Metrics.run,
+            "seconds": round(time.perf_counter() - Metrics._start_time, 4),
+            "peak_rss_mb": Metrics.peak_rss_mb(),
+            "totals": totals,
+            "stage_totals": stage_totals,
+            "units": Metrics.counters,
+            "stages": Metrics.stages
+        }
+        if Metrics.memory:
+            summary["memory"] = Metrics._memory_summary()
+        return summary
+
+    @staticmethod
+    def _memory_summary() -> dict:
+        '''
+        Largest traced and resident peak of the run, of each stage name and of each unit
+        '''
+        Metrics._fold_peaks()
+        stage_peaks, unit_peaks = {}, {}
+        for stage in Metrics.stages:
+            if "traced_peak_mb" not in stage:
+                continue
+            keys = [(stage_peaks, stage["stage"])] + ([(unit_peaks, str(stage["unit"]))] if stage["unit"] is not None else [])
+            for peaks, key in keys:
+                peak = peaks.setdefault(key, {"traced_peak_mb": 0, "stage_rss_peak_mb": 0})
+                peak["traced_peak_mb"] = max(peak["traced_peak_mb"], stage["traced_peak_mb"])
+                peak["stage_rss_peak_mb"] = max(peak["stage_rss_peak_mb"], stage["stage_rss_peak_mb"])
+        run_peaks = Metrics._open[0]
+        budget = MEMORY_BUDGETS_MB.get(Metrics.run["name"])
+        return {
+            "traced_peak_mb": round(run_peaks["traced"] / 1048576, 1),
+            "rss_peak_mb": run_peaks["rss"],
+            "budget_mb": budget,
+            "over_budget": budget is not None and run_peaks["rss"] > budget,
+            "stages": stage_peaks,
+            "units": unit_peaks,
+            "top_allocations": Metrics.top_allocations
+        }
+
+    @staticmethod
+    def _prometheus(summary: dict) -> str:
+        run = summary["name"]
+        lines = [
+            "# TYPE maple_west_run_seconds gauge",
+            f'maple_west_run_seconds{{run="{run}"}} {summary["seconds"]}',
+            "# TYPE maple_west_peak_rss_mb gauge",
+            f'maple_west_peak_rss_mb{{run="{run}"}} {summary["peak_rss_mb"]}',
+            "# TYPE maple_west_stage_seconds gauge"
+        ]
+        for stage, seconds in summary["stage_totals"].items():
+            lines.append(f'maple_west_stage_seconds{{run="{run}",stage="{stage}"}} {seconds}')
+        for unit, unit_counters in summary["units"].items():
+            for counter, value in unit_counters.items():
+                lines.append(f'maple_west_{counter}{{run="{run}",unit="{unit}"}} {value}')
+        if "memory" in summary:
+            lines.append("# TYPE maple_west_stage_traced_peak_mb gauge")
+            for stage, peaks in summary["memory"]["stages"].items():
+                lines.append(f'maple_west_stage_traced_peak_mb{{run="{run}",stage="{stage}"}} {peaks["traced_peak_mb"]}')
+        lines.append(f'maple_west_last_run_timestamp{{run="{run}"}} {int(time.time())}')
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def finish(prometheus: bool = False):
+        '''
+        Write the run summary to Logs/ as JSON and optionally as a Prometheus textfile
+
+        param: prometheus: bool: also write Logs/maple_west_<run>.prom
+        return: dict: run summary, None if instrumentation was not enabled
+        '''
+        if not Metrics.enabled:
+            return None
+        summary = Metrics.summary()
+        if Metrics.memory:
+            Metrics._sampler_stop.set()
+            # The sampler may be taking a snapshot, which fails once tracing stops
+            Metrics._sampler.join()
+            tracemalloc.stop()
+            Metrics.memory = False
+            if summary["memory"]["over_budget"]:
+                Log.write(f"{summary['name']} run used {summary['memory']['rss_peak_mb']} MB, over its {summary['memory']['budget_mb']} MB budget")
+        if not os.path.exists(Metrics.path):
+            os.makedirs(Metrics.path)
+        with open(os.path.join(Metrics.path, f'{summary["date"]}_{summary["name"]}_metrics.json'), 'w') as f:
+            json.dump(summary, f, indent=4)
+        if prometheus:
+            # Write to a temp file and rename so the node exporter never reads a partial file
+            prom_path = os.path.join(Metrics.path, f'maple_west_{summary["name"]}.prom')
+            with open(prom_path + '.tmp', 'w') as f:
+                f.write(Metrics._prometheus(summary))
+            os.replace(prom_path + '.tmp', prom_path)
+        Metrics.enabled = False
+        return summary
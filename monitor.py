@@ -0,0 +1,178 @@
+TIMEOUT_SEC = 30
+import socket
+socket.setdefaulttimeout(TIMEOUT_SEC)
+import re
+import sys
+import time
+from io import BytesIO
+from datetime import datetime, timedelta
+import pandas as pd
+from unit import Unit
+from channels import check_channels
+from rules import check_missing_rows, check_total_energy
+from daily import load_units
+from alert import send_email
+from log import Log
+from color import color
+import dashbox
+
+POLL_MINUTES = 10
+BUFFER_MINUTES = 180 # Rows kept per unit, also the window used for activity checks
+STALE_MINUTES = 30 # Alert when a dashbox has produced no new rows for this long
+MAX_FAILURES = 2 # Consecutive failed polls before a dashbox is reported unreachable
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+TIMESTAMP_REGEX = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
+
+class UnitMonitor:
+    '''
+    Near-real-time monitor for one unit.
+    Keeps a fixed-size buffer of the most recent minutes and only checks rows that are new since the last poll.
+    '''
+    def __init__(self, unit: Unit, buffer_minutes: int = BUFFER_MINUTES, stale_minutes: int = STALE_MINUTES):
+        self.unit = unit
+        self.buffer_minutes = buffer_minutes
+        self.stale_minutes = stale_minutes
+        self.buffer = None
+        self.last_timestamp = None
+        self.failures = 0
+        self.reported = set()
+
+    def _url(self, date: str) -> str:
+        return f'http://{self.unit.ip_address}:{self.unit.port}/index.php/pages/export/exportDaily/{self.unit.serial}/{date}'
+
+    def _fetch_new_rows(self, date: str) -> pd.DataFrame:
+        '''
+        Fetch the rows of a daily export that are newer than the last seen timestamp.
+        The dashbox writes the newest minute first, so reading stops at the first row already seen
+        and the rest of the export is never transferred.
+
+        param: date: str: date of the export in YYYY-MM-DD format
+        return: pd.DataFrame: new rows, empty if there are none
+        '''
+        limit = None if self.last_timestamp else self.buffer_minutes
+        lines = []
+        with dashbox.get(self._url(date), read_timeout=TIMEOUT_SEC, stream=True) as response:
+            response_lines = response.iter_lines()
+            header = next(response_lines, b'') + b'\n'
+            descending = None
+            for line in response_lines:
+                line += b'\n'
+                timestamp = line.split(b',', 1)[0].decode().strip()
+                if not TIMESTAMP_REGEX.fullmatch(timestamp):
+                    continue
+                if descending is None and lines:
+                    descending = timestamp < lines[-1].split(b',', 1)[0].decode().strip()
+                if descending and self.last_timestamp and timestamp <= self.last_timestamp:
+                    break
+                lines.append(line)
+                if descending and limit and len(lines) >= limit:
+                    break
+        if not lines:
+            return pd.DataFrame()
+        data = self.unit.project_data(pd.read_csv(BytesIO(header + b''.join(lines)), on_bad_lines='skip', usecols=self.unit._keep_column))
+        data[data.columns[0]] = pd.to_datetime(data[data.columns[0]], format=TIME_FORMAT, errors='coerce')
+        data = self.unit.sort_data(data.dropna(subset=[data.columns[0]]))
+        if self.last_timestamp:
+            data = data[data.iloc[:, 0] > pd.Timestamp(self.last_timestamp)]
+        return data.tail(self.buffer_minutes).reset_index(drop=True)
+
+    def _report(self, key, message: str) -> list[str]:
+        '''
+        Report a message once per key
+        '''
+        if key in self.reported:
+            return []
+        self.reported.add(key)
+        Log.write(f"Monitor: {message}")
+        print(f"{color.YELLOW}{message}{color.END}")
+        return [message]
+
+    def _is_new(self, message: str) -> bool:
+        match = TIMESTAMP_REGEX.search(message)
+        return match is None or self.last_timestamp is None or match.group(0) > self.last_timestamp
+
+    def poll(self) -> list[str]:
+        '''
+        Fetch the rows added since the last poll and check them
+
+        return: list[str]: alert messages that have not been reported before
+        '''
+        now = datetime.now()
+        dates = [now.strftime('%Y-%m-%d')]
+        if self.last_timestamp and self.last_timestamp[:10] < dates[0]:
+            # Finish the previous day's export after midnight
+            dates.insert(0, self.last_timestamp[:10])
+        try:
+            new_rows = [self._fetch_new_rows(date) for date in dates]
+        except Exception as e:
+            self.failures += 1
+            print(f"{color.RED}{self.unit}: Failed to poll dashbox: {str(e)}{color.END}")
+            if self.failures >= MAX_FAILURES:
+                return self._report(('unreachable', dates[-1]), f"{self.unit}: Dashbox unreachable, {self.unit.ip_address}:{self.unit.port}")
+            return []
+        self.failures = 0
+        new_rows = [rows for rows in new_rows if not rows.empty]
+        if not new_rows:
+            if self.last_timestamp and now - datetime.strptime(self.last_timestamp, TIME_FORMAT) > timedelta(minutes=self.stale_minutes):
+                return self._report(('stale', self.last_timestamp), f"{self.unit}: No new data since {self.last_timestamp}")
+            return []
+        new = pd.concat(new_rows, ignore_index=True)
+        self.buffer = new if self.buffer is None else pd.concat([self.buffer, new], ignore_index=True)
+        self.buffer = self.buffer.tail(self.buffer_minutes).reset_index(drop=True)
+
+        issues = self.check(new)
+        self.last_timestamp = new.iloc[-1, 0].strftime(TIME_FORMAT)
+        alerts = []
+        for message in issues:
+            # Messages without a timestamp (e.g. no response over the buffer) are reported once per day
+            key = message if TIMESTAMP_REGEX.search(message) else (message, dates[-1])
+            alerts += self._report(key, f"{self.unit}: {message}" if not message.startswith(str(self.unit)) else message)
+        return alerts
+
+    def check(self, new: pd.DataFrame) -> list[str]:
+        '''
+        Run the gap, energy, limit and activity checks.
+        Gap and channel checks run over the fixed-size buffer so their counters have context,
+        energy runs on the new rows only, and only messages about new timestamps are kept.
+
+        param: new: pd.DataFrame: rows added since the last poll
+        return: list[str]: errors about the new rows
+        '''
+        unit_no = self.unit.unit_no
+        window, errors, _, bad_indices = check_missing_rows(self.buffer.copy(), unit_no)
+        new_window = window[window.iloc[:, 0] >= new.iloc[0, 0]].reset_index(drop=True)
+        energy_errors, _ = check_total_energy(new_window, unit_no)
+        errors += energy_errors
+        channel_errors, _ = check_channels(window, unit_no, self.unit.plan, bad_indices)
+        errors += channel_errors
+        return [error for error in errors if self._is_new(error)]
+
+def send_alerts(alerts: list[str]):
+    body = "Issues detected by the Maple West monitor:\n\n" + "\n".join(alerts)
+    send_email(subject=f"Maple West Monitor Alert", body=body)
+
+def run(interval: int = POLL_MINUTES, once: bool = False):
+    '''
+    Poll every dashbox on a fixed interval and email new issues as they appear
+
+    param: interval: int: minutes between polls
+    param: once: bool: poll a single time and return
+    '''
+    monitors = [UnitMonitor(unit) for unit in load_units('config/')]
+    while True:
+        started = time.monotonic()
+        # Monitor log lines go to the log file of the current yesterday
+        Unit.refresh_dates()
+        alerts = []
+        for monitor in monitors:
+            alerts += monitor.poll()
+        if alerts:
+            send_alerts(alerts)
+        if once:
+            return alerts
+        time.sleep(max(0, interval * 60 - (time.monotonic() - started)))
+
+if __name__ == "__main__":
+    # python monitor.py [--interval MINUTES] [--once]
+    interval = int(sys.argv[sys.argv.index('--interval') + 1]) if '--interval' in sys.argv else POLL_MINUTES
+    run(interval, once='--once' in sys.argv)
@@ -0,0 +1,191 @@
+import os
+import json
+import calendar
+import pandas as pd
+from log import Log
+from color import color
+from metrics import Metrics
+from storage import csv_name, csv_stem, is_csv, compress_file
+
+COMBINED_PATH = './Combined_Data'
+PART_SUFFIX = '.part' # Running month files are not .csv until finalized, so they are never uploaded half done
+CHUNK_BYTES = 1 << 20 # Copy size when splicing a rewritten day into a month file
+
+def _paths(unit_no, month: str, combined_path: str):
+    unit_dir = os.path.join(combined_path, f'UNIT {unit_no}')
+    stem = f'Unit_{unit_no}_Minute_{month}'
+    return unit_dir, os.path.join(unit_dir, csv_name(stem) + PART_SUFFIX), os.path.join(unit_dir, f'{stem}.manifest.json')
+
+def load_manifest(path: str) -> dict:
+    '''
+    return: dict: month, columns, appended days with their byte offset and rows, file size and whether the
+    month has to be rebuilt from the daily files (stale); empty if there is no manifest
+    '''
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def _write_manifest(path: str, manifest: dict):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, path)
+
+def _read_day(path: str) -> pd.DataFrame:
+    '''
+    Read a saved minute day the same way monthly.combine_csv_files does
+    '''
+    cols = pd.read_csv(path, nrows=1).columns.size
+    df = pd.read_csv(path, on_bad_lines=lambda x: x[:cols], engine='python')
+    if len(df) > 1 and df.iloc[0, 0] > df.iloc[1, 0]:
+        df = df.iloc[::-1]
+    return df
+
+def _mark_stale(manifest_path: str, manifest: dict, unit_no, reason: str):
+    if not manifest.get("stale"):
+        Log.write(f"Unit {unit_no}: {manifest['month']} combined file will be rebuilt at month end: {reason}")
+    manifest["stale"] = True
+    _write_manifest(manifest_path, manifest)
+
+def append_day(unit_no, path: str, combined_path: str = COMBINED_PATH) -> bool:
+    '''
+    Append a saved minute day to the unit's running month file and record it in the month's manifest.
+    Days have to arrive in order; a rerun of the last appended day replaces it, anything else (an earlier
+    day, a day seen before or new columns) marks the month stale so finalize leaves it to a full rebuild.
+
+    param: unit_no: int: unit number
+    param: path: str: saved minute file, named Unit_{unit_no}_{YYYY-MM-DD}.csv[.gz|.zst]
+    return: bool: True if the day was appended
+    '''
+    day = csv_stem(os.path.basename(path)).split('_')[-1]
+    month = day[:7]
+    unit_dir, part_path, manifest_path = _paths(unit_no, month, combined_path)
+    os.makedirs(unit_dir, exist_ok=True)
+    manifest = load_manifest(manifest_path) or {"month": month, "columns": None, "days": {}, "size": 0, "stale": False}
+    if manifest["stale"]:
+        return False
+    days = sorted(manifest["days"])
+    if days and day == days[-1]:
+        # Rerun of the last day, drop its rows and append them again
+        manifest["size"] = manifest["days"].pop(day)["offset"]
+    elif days and day <= days[-1]:
+        _mark_stale(manifest_path, manifest, unit_no, f"{day} arrived after {days[-1]}")
+        return False
+
+    with Metrics.stage("append_month", unit_no):
+        df = _read_day(path)
+        columns = list(df.columns)
+        if manifest["columns"] is None:
+            manifest["columns"] = columns
+        elif columns != manifest["columns"]:
+            if not set(columns) <= set(manifest["columns"]):
+                _mark_stale(manifest_path, manifest, unit_no, f"{day} has columns the month file does not")
+                return False
+            # Columns missing from this day are left empty, like concatenating the days would
+            df = df.reindex(columns=manifest["columns"])
+        # Cut off anything after the recorded size, e.g. a partial append from a run that was killed
+        with open(part_path, 'ab') as f:
+            f.truncate(manifest["size"])
+        df.to_csv(part_path, mode='a', header=manifest["size"] == 0, index=False)
+    manifest["days"][day] = {"offset": manifest["size"], "rows": len(df)}
+    manifest["size"] = os.path.getsize(part_path)
+    _write_manifest(manifest_path, manifest)
+    return True
+
+def _copy_bytes(source, destination, length: int):
+    while length > 0:
+        chunk = source.read(min(CHUNK_BYTES, length))
+        if not chunk:
+            break
+        destination.write(chunk)
+        length -= len(chunk)
+
+def replace_day(unit_no, path: str, combined_path: str = COMBINED_PATH) -> bool:
+    '''
+    Splice a rewritten saved day (e.g. by gapfill) into the running month file in place of its old rows,
+    using the byte offsets in the manifest; the days after it are copied over and their offsets moved.
+    A finalized month, a file that does not match its manifest or a day with new columns marks the month stale.
+
+    param: unit_no: int: unit number
+    param: path: str: rewritten minute file, named Unit_{unit_no}_{YYYY-MM-DD}.csv[.gz|.zst]
+    return: bool: True if the day was replaced
+    '''
+    day = csv_stem(os.path.basename(path)).split('_')[-1]
+    _, part_path, manifest_path = _paths(unit_no, day[:7], combined_path)
+    manifest = load_manifest(manifest_path)
+    if not manifest or manifest["stale"] or day not in manifest["days"]:
+        return False
+    if manifest.get("finalized") or not os.path.exists(part_path) or os.path.getsize(part_path) < manifest["size"]:
+        _mark_stale(manifest_path, manifest, unit_no, f"{day} was rewritten")
+        return False
+
+    with Metrics.stage("replace_month_day", unit_no):
+        df = _read_day(path)
+        if list(df.columns) != manifest["columns"]:
+            if not set(df.columns) <= set(manifest["columns"]):
+                _mark_stale(manifest_path, manifest, unit_no, f"{day} was rewritten with columns the month file does not have")
+                return False
+            df = df.reindex(columns=manifest["columns"])
+        days = sorted(manifest["days"])
+        later = days[days.index(day) + 1:]
+        start = manifest["days"][day]["offset"]
+        end = manifest["days"][later[0]]["offset"] if later else manifest["size"]
+        rows = df.to_csv(index=False, header=start == 0).encode()
+        # Stale while the file is rewritten, so a run killed in between rebuilds the month instead of trusting the offsets
+        manifest["stale"] = True
+        _write_manifest(manifest_path, manifest)
+        tmp_path = f'{part_path}.tmp'
+        with open(part_path, 'rb') as source, open(tmp_path, 'wb') as destination:
+            _copy_bytes(source, destination, start)
+            destination.write(rows)
+            source.seek(end)
+            _copy_bytes(source, destination, manifest["size"] - end)
+        os.replace(tmp_path, part_path)
+    shift = len(rows) - (end - start)
+    manifest["days"][day] = {"offset": start, "rows": len(df)}
+    for later_day in later:
+        manifest["days"][later_day]["offset"] += shift
+    manifest["size"] += shift
+    manifest["stale"] = False
+    _write_manifest(manifest_path, manifest)
+    return True
+
+def finalize(unit_no, month: str, minute_dir: str, compression=None, combined_path: str = COMBINED_PATH) -> bool:
+    '''
+    Turn a running month file into the combined file uploaded by monthly.py.
+    The month file is only used if it holds exactly the days saved in the unit's Minute_Data folder and its
+    size matches the manifest; otherwise the caller combines the daily files as before.
+
+    param: minute_dir: str: the unit's Minute_Data folder
+    param: compression: str: None, 'gzip' or 'zstd' for the combined file
+    return: bool: True if the combined file is ready
+    '''
+    unit_dir, part_path, manifest_path = _paths(unit_no, month, combined_path)
+    manifest = load_manifest(manifest_path)
+    output_path = os.path.join(unit_dir, csv_name(f'Unit_{unit_no}_Minute_{month}', compression))
+    if not manifest or manifest["stale"]:
+        return False
+    if manifest.get("finalized") and os.path.exists(output_path):
+        return True
+    if not os.path.exists(part_path) or os.path.getsize(part_path) != manifest["size"]:
+        Log.write(f"Unit {unit_no}: {month} month file does not match its manifest, rebuilding")
+        return False
+    saved = {csv_stem(file).split('_')[-1] for file in os.listdir(minute_dir) if is_csv(file)} if os.path.isdir(minute_dir) else set()
+    if saved != set(manifest["days"]):
+        Log.write(f"Unit {unit_no}: {month} month file has {len(manifest['days'])} days, Minute_Data has {len(saved)}, rebuilding")
+        return False
+
+    month_days = {f'{month}-{day:02d}' for day in range(1, calendar.monthrange(int(month[:4]), int(month[5:]))[1] + 1)}
+    missing = sorted(month_days - saved)
+    if missing:
+        Log.write(f"Unit {unit_no}: {month} combined file is missing {len(missing)} days: {', '.join(missing)}")
+        print(f"{color.YELLOW}Unit {unit_no}: {month} combined file is missing {len(missing)} days{color.END}")
+    with Metrics.stage("finalize_month", unit_no):
+        compress_file(part_path, output_path, compression)
+    Metrics.add("rows_combined", sum(day["rows"] for day in manifest["days"].values()), unit_no)
+    os.remove(part_path)
+    manifest["finalized"] = True
+    _write_manifest(manifest_path, manifest)
+    print(f"Combined CSV file finalized at {output_path}")
+    return True
@@ -1,4 +1,5 @@
 import os
+import sys
 import pandas as pd
 import re
 from googleapiclient.discovery import build
@@ -12,6 +13,16 @@ from dateutil.relativedelta import relativedelta
 from rules import check_missing_rows
 from alert import alert_failed_downloads
 import qualitycheck
+from qualitystore import QualityStore
+from metrics import Metrics
+from storage import check_compression, csv_name, is_csv, mimetype
+from monthfile import finalize
+import dashbox
+from breaker import CircuitBreaker
+from registry import UnitRegistry
+from unit import status_url
+from log import Log
+from urllib.parse import urlsplit
 
 SERVICE_ACCOUNT_JSON = 'service_account.json'
 SCOPES = ['https://www.googleapis.com/auth/drive']
@@ -27,26 +38,6 @@ FAILED_DOWNLOAD_PATH = './failed_downloads.txt'
 QUALITY_REPORTS_PATH = './quality_reports'
 QUALITY_REPORTS_FOLDER = '1VTlQzomRsOXTUEOKfOaH94J15WApczri'
 
-locations = {
-    "UNIT 77": "1lDSBeFE5p9snL9rHBVBzsnQcX_0YV5Ju",
-    "UNIT 78": "103QnxldwU07-yrlA4XFQGMpmya0EIcW2",
-    "UNIT 79": "1RnVLcH2rV4jhsi0GY6N3x_-PmpRzmqRY",
-    "UNIT 80": "1fSk1ikNSaR8P-F19RglXOgYg5cF1DHyy",
-    "UNIT 81": "1jlytoisi-JISBRencOaqHxaKYCny1rFA",
-    "UNIT 82": "1Siq34KBC1QNIvcKokOOhpMo3-RCVQYIH",
-    "UNIT 83": "1KfAAEJgonrEoL5ffP8VHCflg44no_ddm",
-    "UNIT 84": "1-rpJ59XpGoNjscg-Rra9EvNbMR8Oy8MJ",
-    "UNIT 85": "1AMKvlt7pm7_8Y_zsbaWTTZu7QRopzUdU",
-    "UNIT 86": "1wwnoiYmlNAZKRCJ4o3yIbrrTT_KXLbe1",
-    "UNIT 2804": "1MsjQ5IgvnU5TGUBXPKWWFMvJme682SNH",
-    "UNIT 2806": "1SxUChu2uQ6_A9x8ZPFMvi0SXaDq9-Y7y",
-    "UNIT 2808": "1kofZCSXwdgdjx01qu_ruOV8zKohyBNTE",
-    "UNIT 2810": "1ANJLFZ_Ve0BHlH94KKHdz9F_AvPKwHBs",
-    "UNIT 2812": "17Zuo7fpmpU5PeBKmqD0ICqHoAyMCBQ8r",
-    "UNIT 2814": "1qsbxo7iD4L7NRHFsQVNDxWMbuCosm3Cq",
-    "UNIT 2816": "1NpPsGArjNYETE7jG1wdROZESslTaUz5w",
-    "UNIT 2818": "1nXd5l88n6KmSdAonIq7pDiFBsaZ5NeQd"
-}
 
 def natural_sort_key(s):
     return [int(text) if text.isdigit() else text.lower() for text in re.split('(\\d+)', s)]
@@ -57,7 +48,7 @@ def combine_csv_files(input_folder):
     csv_files = []
     for root, _, files in os.walk(input_folder):
         for file in files:
-            if file.endswith('.csv'):
+            if is_csv(file):
                 csv_files.append(os.path.join(root, file))
             else:
                 print('File does not end in .csv:' + file)
@@ -78,6 +69,7 @@ def combine_csv_files(input_folder):
         cols = pd.read_csv(file, nrows=1).columns.size
         print("Reading file: ", file)
         df = pd.read_csv(file, on_bad_lines=lambda x: x[:cols], engine='python')
+        Metrics.add("rows_parsed", len(df))
         if df.iloc[0, 0] > df.iloc[1, 0]:
             df = df.iloc[::-1]
         dfs.append(df)
@@ -86,31 +78,38 @@ def combine_csv_files(input_folder):
     
     return combined_data
 
-def save_to_csv(df, output_folder, unit_no, datatype):
+def save_to_csv(df, output_folder, unit_no, datatype, compression=None):
     # Create the output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
     
-    # Save the DataFrame to a new CSV file in the output folder
+    # Save the DataFrame to a new CSV file in the output folder, compressed according to the file extension
     last_month = (datetime.today() - relativedelta(months=1)).strftime('%Y-%m')
-    output_file_path = os.path.join(output_folder, f'Unit_{unit_no}_{datatype}_{last_month}.csv')
+    output_file_path = os.path.join(output_folder, csv_name(f'Unit_{unit_no}_{datatype}_{last_month}', compression))
     df.to_csv(output_file_path, index=False)
     
     print(f"Combined CSV file saved successfully at {output_file_path}")
 
-def combine_all(input_path, output_path):
+def combine_all(input_path, output_path, compression=None):
     for _, dirs, _ in os.walk(input_path):
         for dir in dirs:
             in_path = os.path.join(input_path, dir)
             out_path = os.path.join(output_path, dir)
             unit_no = dir.split(' ')[-1]
-            df = combine_csv_files(in_path)
             datatype = ""
             if "Minute" in input_path:
                 datatype = "Minute"
             else:
                 datatype = "Hour"
+            # Months appended day by day by daily.py only need finalizing, the rest are combined here
+            last_month = (datetime.today() - relativedelta(months=1)).strftime('%Y-%m')
+            if datatype == "Minute" and finalize(unit_no, last_month, in_path, compression, output_path):
+                print(f"Unit {unit_no} combined successfully.")
+                continue
+            with Metrics.stage("combine", unit_no):
+                df = combine_csv_files(in_path)
             if not df.empty:
-                save_to_csv(df, out_path, unit_no, datatype)
+                with Metrics.stage("save_combined", unit_no):
+                    save_to_csv(df, out_path, unit_no, datatype, compression)
                 print(f"Unit {unit_no} combined successfully.")
             else:
                 print(f"{color.RED}Unit {unit_no} could not be combined.{color.END}")
@@ -121,12 +120,18 @@ def upload_combined(combined_path):
         for dir in dirs:
             unit_no = dir.split(' ')[-1]
             folder_path = os.path.join(combined_path, dir)
+            # Each unit's Drive folder is set in its config, a unit without one is skipped instead of stopping the upload
+            folder = UnitRegistry.get().drive_folder(int(unit_no))
+            if folder is None:
+                Log.write(f"Unit {unit_no}: No drive_folder in config, combined files not uploaded")
+                print(f"{color.RED}Unit {unit_no}: No drive_folder in config, combined files not uploaded{color.END}")
+                continue
             for root, _, files in os.walk(folder_path):
                 for file in files:
-                    if file.endswith('.csv'):
+                    if is_csv(file):
                         file_path = os.path.join(root, file)
                         # Check if file already exists
-                        query = f"name='{file}' and '{locations[dir]}' in parents and trashed=false"
+                        query = f"name='{file}' and '{folder}' in parents and trashed=false"
                         results = drive_service.files().list(
                             q=query,
                             fields="files(id, name)",
@@ -135,22 +140,22 @@ def upload_combined(combined_path):
                         ).execute()
                         
                         if results.get('files', []):
-                            print(f"{file} already exists in Google Drive folder {locations[dir]} for Unit {unit_no}")
+                            print(f"{file} already exists in Google Drive folder {folder} for Unit {unit_no}")
                             continue
                             
                         # Upload file
                         file_metadata = {
                             'name': file,
-                            'parents': [locations[dir]]
+                            'parents': [folder]
                         }
-                        media = MediaFileUpload(file_path, resumable=True)
+                        media = MediaFileUpload(file_path, mimetype=mimetype(file), resumable=True)
                         uploaded_file = drive_service.files().create(
                             body=file_metadata,
                             media_body=media,
                             fields='id',
                             supportsAllDrives=True
                         ).execute()
-                        print(f"Uploaded {file} to Google Drive folder {locations[dir]} for Unit {unit_no}")
+                        print(f"Uploaded {file} to Google Drive folder {folder} for Unit {unit_no}")
 
 def delete_all(paths:list):
     for folder in paths:
@@ -172,24 +177,36 @@ def fix_order(df:pd.DataFrame):
     else:
         return df
 
-def download_failed(failed_units_path: str):
+def download_failed(failed_units_path: str, compression=None):
+    breaker = CircuitBreaker()
     with open(failed_units_path, 'r+') as f:
         lines = f.readlines()  # Read all lines
         new_lines = []  # Store lines that should remain
         for line in lines:
             if line.strip() == "":
                 continue  # Skip empty lines
+            unit_no = None
             try:
                 unit_no, datatype, url = line.strip().split(', ')
+                # Days of units that are still offline are kept for a later run instead of timing out again
+                if not breaker.allow(unit_no, status_url(urlsplit(url).netloc)):
+                    new_lines.append(line)
+                    continue
                 print(f"Attempting to download Unit {unit_no}, {datatype} from {url}")
-                data = fix_order(pd.read_csv(url, header=0, on_bad_lines='skip'))
+                with Metrics.stage("download", unit_no):
+                    data = fix_order(pd.read_csv(BytesIO(dashbox.fetch(url)), header=0, on_bad_lines='skip'))
+                Metrics.add("rows_parsed", len(data), unit_no)
                 data, _, _, _ = check_missing_rows(data, unit_no)
                 date = url.split('/')[-1].strip()
-                data.to_csv(f'./{datatype}_Data/UNIT {str(unit_no)}/Unit_{str(unit_no)}_{str(date)}.csv', index=False)
+                data.to_csv(f'./{datatype}_Data/UNIT {str(unit_no)}/' + csv_name(f'Unit_{str(unit_no)}_{str(date)}', compression), index=False)
                 print(f"{color.GREEN}Download successful{color.END}")
+                breaker.record(unit_no, True)
             except:
                 print(f"{color.RED}Unit {unit_no} could not be downloaded from {url}{color.END}")
                 new_lines.append(line)  # Keep this line if download fails
+                # A failed retry moves the unit's next attempt out, its remaining lines then only cost the cached probe
+                if unit_no is not None:
+                    breaker.record(unit_no, False)
         f.seek(0)  # Move cursor to start of file
         f.truncate(0)  # Clear the file
         f.writelines(new_lines)  # Write back only failed lines
@@ -262,12 +279,33 @@ def upload_quality_reports():
             ).execute()
             print(f"Uploaded {file} to Google Drive quality reports folder")
 
+def main(metrics: bool = False, prometheus: bool = False, compression=None, memory: bool = False):
+    check_compression(compression)
+    if metrics or memory:
+        Metrics.start("monthly", (datetime.today() - relativedelta(months=1)).strftime('%Y-%m'), memory)
+    with Metrics.stage("download_failed"):
+        download_failed(FAILED_DOWNLOAD_PATH, compression)
+    with Metrics.stage("combine_all"):
+        combine_all(MINUTE_PATH, OUTPUT_PATH, compression)
+    # The quality store is the state, the xlsx reports on Drive are only needed to bootstrap it once
+    if not QualityStore().units():
+        with Metrics.stage("download_quality_reports"):
+            download_quality_reports()
+    with Metrics.stage("quality_check"):
+        qualitycheck.main()
+    with Metrics.stage("upload_combined"):
+        upload_combined(OUTPUT_PATH)
+    with Metrics.stage("upload_quality_reports"):
+        upload_quality_reports()
+    with Metrics.stage("delete_all"):
+        delete_all([MINUTE_PATH, HOUR_PATH, OUTPUT_PATH])
+    with Metrics.stage("email"):
+        alert_failed_downloads(FAILED_DOWNLOAD_PATH)
+    Metrics.finish(prometheus)
+
 if __name__ == '__main__':
-    download_failed(FAILED_DOWNLOAD_PATH)
-    combine_all(MINUTE_PATH, OUTPUT_PATH)
-    download_quality_reports()
-    qualitycheck.main()
-    upload_combined(OUTPUT_PATH)
-    upload_quality_reports()
-    delete_all([MINUTE_PATH, HOUR_PATH, OUTPUT_PATH])
-    alert_failed_downloads(FAILED_DOWNLOAD_PATH)
\ No newline at end of file
+    # --compress gzip|zstd writes and uploads compressed combined files
+    # --memory adds per-stage peak memory and the top allocation sites to the metrics, the run is slower
+    main(metrics='--metrics' in sys.argv or '--prometheus' in sys.argv, prometheus='--prometheus' in sys.argv,
+         compression=sys.argv[sys.argv.index('--compress') + 1] if '--compress' in sys.argv else None,
+         memory='--memory' in sys.argv)
\ No newline at end of file
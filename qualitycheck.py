@@ -1,16 +1,17 @@
 import os
 import pandas as pd
-import json
 from datetime import datetime
 from channels import channels
-import numpy as np
-from openpyxl import load_workbook
 from openpyxl.styles import PatternFill
-from openpyxl.formatting.rule import ColorScaleRule
-from openpyxl.utils import get_column_letter
 import calendar
 from unit import Unit
-from rules import check_missing_rows
+from registry import UnitRegistry
+from metrics import Metrics
+from report import write_report, window_rows, ARCHIVE_PATH
+from qualitystore import QualityStore, STORE_PATH
+from rollup import summarize_minutes
+from storage import is_csv, csv_stem
+import sys
 import warnings
 warnings.filterwarnings(
     "ignore",
@@ -18,40 +19,55 @@ warnings.filterwarnings(
     category=UserWarning
 )
 
-block_1 = [2804, 2806, 2808, 2810, 2812, 2814, 2816, 2818]
-block_3 = [77, 78, 79, 80, 81, 82, 83, 84, 85, 86]
+MAX_DAILY_ROWS = None # Keep at most this many days in the daily sheets, older days are archived as csv
+MINUTE_PATH = 'Minute_Data'
+# Sheets of the combined report and the derived monthly column each one holds for every unit
+FLEET_SHEETS = {
+    'Monthly Electricity': 'Total Electricity',
+    'Monthly Gas': 'Gas',
+    'Monthly Temperature': 'Temperature',
+    'Monthly Pulse': 'Pulse'
+}
+
+def _update_periods(df: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Write the periods and channels of new into df, keeping the rows and columns of df that new does not have
+    '''
+    df = df.reindex(index=df.index.append(new.index.difference(df.index)),
+                    columns=list(df.columns) + [column for column in new.columns if column not in df.columns])
+    df.loc[new.index, new.columns] = new
+    return df.sort_index().astype(float)
 
 class QualityChecker:
-    def __init__(self, config_path='config/'):
-        self.units = self._load_units(config_path)
+    def __init__(self, config_path='config/', store_path=STORE_PATH):
+        self.units = UnitRegistry.get(config_path).units()
+        self._units = {unit.unit_no: unit for unit in self.units}
+        self.store = QualityStore(store_path)
         self.red_fill = PatternFill(start_color='FFFF0000', end_color='FFFF0000', fill_type='solid')
         self.yellow_fill = PatternFill(start_color='FFFFFF00', end_color='FFFFFF00', fill_type='solid')
         
-    def _load_units(self, config_path: str) -> list[Unit]:
+    def unit(self, unit_no) -> Unit:
         '''
-        Load unit config jsons from folder path
-
-        param: config_path: str: path to the config file
-        return: list[Unit]: list of units
+        Look up a unit by number, raises KeyError if it is not configured
         '''
-        units = []
-        for file in os.listdir(config_path):
-            if file.endswith('.json'):
-                with open(os.path.join(config_path, file), 'r') as f:
-                    unit = json.load(f)
-                    units.append(Unit(unit['unit_no'], unit['block'], unit['ip_address'], unit['port'], unit['serial'], unit['channels']))
-        return sorted(units)
+        if unit_no not in self._units:
+            raise KeyError(f"Unit {unit_no} is not configured")
+        return self._units[unit_no]
 
     def _load_quality_report(self, unit, path=""):
         '''
-        Find the quality report for a specific unit
+        Load the quality percentages of a unit from the store.
+        A unit the store has never seen is bootstrapped once from its existing xlsx report.
 
-        param: unit: str: unit number
-        return: str: path to the quality report
+        param: unit: Unit: unit to load
+        param: path: str: path to the legacy xlsx report
+        return: tuple: (bad_df_daily, missing_df_daily, bad_df_monthly, missing_df_monthly)
         '''
         unit_no = unit.unit_no
-        unit = [unit for unit in self.units if unit.unit_no == unit_no][0]
-        monitored_channels = [channel for channel, key in unit.channels.items() if key == True]
+        unit = self.unit(unit_no)
+        monitored_channels = list(unit.plan)
+        if self.store.has_unit(unit_no):
+            return self.store.load(unit_no, monitored_channels)
         bad_df_daily = pd.DataFrame(columns=monitored_channels)
         missing_df_daily = pd.DataFrame(columns=monitored_channels)
         bad_df_monthly = pd.DataFrame(columns=monitored_channels)
@@ -77,94 +93,72 @@ class QualityChecker:
                         missing_df_monthly.index = missing_df_monthly.index.strftime('%Y-%m')
             except Exception as e:
                 print(f"Error reading existing report: {str(e)}")
+            self.store.save(unit_no, ((bad_df_daily, missing_df_daily), (bad_df_monthly, missing_df_monthly)))
         return (bad_df_daily, missing_df_daily, bad_df_monthly, missing_df_monthly)
 
+    def _backfill_rollups(self, unit) -> int:
+        '''
+        Summarize the stored minute days of a unit that are not in the rollup store yet.
+        Days are read, summarized and released one file at a time, so memory does not grow with the
+        number of days; the percentages only need the per-day counts kept in the store.
+
+        param: unit: Unit: unit to summarize
+        return: int: number of day files summarized
+        '''
+        unit_dir = os.path.join(MINUTE_PATH, f'UNIT {unit.unit_no}')
+        if not os.path.isdir(unit_dir):
+            return 0
+        summarized = self.store.rollup_periods(unit.unit_no, 'day')
+        files = [f for f in os.listdir(unit_dir) if is_csv(f) and csv_stem(f).split('_')[-1] not in summarized]
+        files.sort(key=unit._natural_sort_key)
+        for file in files:
+            day = csv_stem(file).split('_')[-1]
+            with Metrics.stage("load_data", unit.unit_no):
+                data = unit._read_csv(os.path.join(unit_dir, file), project=True)
+            Metrics.add("rows_parsed", len(data), unit.unit_no)
+            # Rows of another day (e.g. the next midnight) are counted from that day's own file
+            data = data[data.iloc[:, 0].astype(str).str.startswith(day)]
+            with Metrics.stage("summarize", unit.unit_no):
+                self.store.save_rollups(unit.unit_no, summarize_minutes(unit, data))
+            del data
+        return len(files)
+
     def check_data_quality(self, unit_no):
         '''
-        Check the quality of the data
+        Check the quality of the data.
+        Minute days not summarized yet are added to the rollup store, then the daily and monthly
+        percentages are computed from the daily rollups instead of the minute data.
         '''
-        unit = [unit for unit in self.units if unit.unit_no == unit_no][0]
+        unit = self.unit(unit_no)
         bad_df_daily, missing_df_daily, bad_df_monthly, missing_df_monthly = self._load_quality_report(unit, f'quality_reports/UNIT {unit_no} REPORT.xlsx')
-        # Get list of dates from unit.data
-        if not unit.load_data(f'Minute_Data/'):
+        self._backfill_rollups(unit)
+        monitored_channels = list(unit.plan)
+        with Metrics.stage("load_rollups", unit_no):
+            rollups = self.store.load_rollups(unit_no, 'day', channels=monitored_channels)
+        if rollups.empty:
             print(f'Unit {unit.unit_no} has no data')
             return ((bad_df_daily, missing_df_daily), (bad_df_monthly, missing_df_monthly))
-        
-        unit.data['Date'] = pd.to_datetime(unit.data['Date'], errors='coerce')
-        unit.data = unit.data.dropna(subset=['Date'])
-        unit.data, _, _, _ = check_missing_rows(unit.data, unit.unit_no)
-        if 'Date' in unit.data.columns:
-            unit.data = unit.data.loc[:, ~unit.data.columns.duplicated()]
-        unit.data.set_index('Date', inplace=True)
-        data = unit.data
-        data = data.sort_index()
-        # Group data by date (each group corresponds to one day)
-        daily_groups = data.groupby(data.index.date)
-        # Extract unique year-month combinations in the format: YYYY-MM
-        unique_months = np.unique([date.strftime('%Y-%m') for date, _ in daily_groups])
-        monitored_channels = [channel for channel, key in unit.channels.items() if key == True]
-        # Process daily quality checks using vectorized operations
-        for date, daily_data in daily_groups:
-            date_str = date.strftime('%Y-%m-%d') 
-            for channel in monitored_channels:
-                min_val = channels[channel].min_value
-                max_val = channels[channel].max_value
-                
-                # Find the column matching the channel regex
-                matching_cols = data.columns[data.columns.str.contains(channels[channel].regex, regex=True)]
-                channel_name = matching_cols[0] if len(matching_cols) > 0 else None
-                if channel_name is None:
-                    continue
 
-                # Create vectorized masks for bad and missing values
-                col_numeric = pd.to_numeric(daily_data[channel_name], errors='coerce')
-                bad_mask = (col_numeric < min_val) | (col_numeric > max_val)
-                missing_mask = col_numeric.isna() | np.isinf(col_numeric)
-                bad_values = bad_mask.sum()
-                missing_values = missing_mask.sum()
-
-                # Compute percentage assuming an expected 1440 data points per day
-                bad_df_daily.loc[date_str, channel] = float(round(float(bad_values) / 1440 * 100, 3))
-                missing_df_daily.loc[date_str, channel] = float(round(float(missing_values) / 1440 * 100, 3))
-                    
+        with Metrics.stage("quality_daily", unit_no):
+            bad = rollups.pivot(index='period', columns='channel', values='bad')
+            count = rollups.pivot(index='period', columns='channel', values='count')
+            # Days without a stored file between the first and last stored day are fully missing
+            days = pd.date_range(bad.index.min(), bad.index.max(), freq='D').strftime('%Y-%m-%d')
+            bad = bad.reindex(days).fillna(0)
+            count = count.reindex(days).fillna(0)
+            # Percentages assume an expected 1440 data points per day
+            bad_df_daily = _update_periods(bad_df_daily, (bad / 1440 * 100).round(3))
+            missing_df_daily = _update_periods(missing_df_daily, ((1440 - count).clip(lower=0) / 1440 * 100).round(3))
         daily = (bad_df_daily, missing_df_daily)
-        for month in unique_months:
-            year = int(month.split('-')[0])
-            month_num = int(month.split('-')[1])
-
-            num_days = calendar.monthrange(year, month_num)[1]
-            # days_list = missing_df_daily.index.str.startswith(month)
-            # actual_num_days = len(missing_df_daily[days_list])
-            # missing_num_days = num_days - actual_num_days
-            expected_num_points = 1440*num_days
-            # Filter data for the current month
-            month_str = month  # month is already in 'YYYY-MM' format from unique_months
-            monthly_data = data[data.index.strftime('%Y-%m') == month_str]
-
-            # Process data for each enabled channel
-            for channel in monitored_channels:
-                min_val = channels[channel].min_value
-                max_val = channels[channel].max_value
-
 
-                # Find the column matching the channel regex
-                matching_cols = data.columns[data.columns.str.contains(channels[channel].regex, regex=True)]
-                channel_name = matching_cols[0] if len(matching_cols) > 0 else None
-                if channel_name is None:
-                    continue
+        with Metrics.stage("quality_monthly", unit_no):
+            months = bad.index.str[:7]
+            unique_months = months.unique()
+            expected_num_points = pd.Series([1440 * calendar.monthrange(int(month[:4]), int(month[5:7]))[1] for month in unique_months], index=unique_months)
+            bad_df_monthly = _update_periods(bad_df_monthly, (bad.groupby(months).sum().div(expected_num_points, axis=0) * 100).round(3))
+            # Points never stored in the month count as missing
+            missing_df_monthly = _update_periods(missing_df_monthly, ((1 - count.groupby(months).sum().div(expected_num_points, axis=0)) * 100).round(3))
 
-                # Create vectorized masks for bad and missing values
-                col_numeric = pd.to_numeric(monthly_data[channel_name], errors='coerce')
-                bad_mask = (col_numeric < min_val) | (col_numeric > max_val)
-                missing_mask = col_numeric.isna() | np.isinf(col_numeric)
-                bad_values = bad_mask.sum()
-                missing_values = missing_mask.sum()
-
-                # Compute percentage using the expected number of data points
-                bad_df_monthly.loc[month_str, channel] = float(round((bad_values)/ (expected_num_points) * 100, 3))
-                missing_num_points = (missing_values + expected_num_points - len(col_numeric))
-                missing_df_monthly.loc[month_str, channel] = float(round(missing_num_points/ (expected_num_points) * 100, 3))
-                monthly = (bad_df_monthly, missing_df_monthly)
         # Add new derived columns to bad_df and missing_df
         for df in [bad_df_monthly, missing_df_monthly]:
             # Sum Main Electricity 1 & 2 with percentage calculation
@@ -180,106 +174,67 @@ class QualityChecker:
             df['Temperature'] = df[temp_cols].mean(axis=1)
             pulse_cols = df.columns[df.columns.str.contains('Cubic', regex=True)]
             df['Pulse'] = df[pulse_cols].mean(axis=1)
+        monthly = (bad_df_monthly, missing_df_monthly)
 
         return (daily, monthly)
 
-    def _format_quality_result(self, path):
-        wb = load_workbook(path)
-        
-        for sheet_name in wb.sheetnames:
-            ws = wb[sheet_name]
-            
-            # Skip sheets with no data
-            if ws.max_row <= 1 or ws.max_column <= 1:
-                continue
-                
-            # Get the maximum row and column
-            max_row = ws.max_row
-            max_col = ws.max_column
-            
-            # Create range string for formatting (B2 to end)
-            end_col_letter = get_column_letter(max_col)
-            data_range = f"B2:{end_col_letter}{max_row}"
-            
-            try:
-                # Create a color scale rule
-                color_scale = ColorScaleRule(
-                    start_type="num", start_value=0, start_color="FFFFFFFF",  # White for 0
-                    end_type="num", end_value=100, end_color="FFFF0000"      # Red for 100
-                )
-                
-                # Apply the color scale to the data range
-                ws.conditional_formatting.add(data_range, color_scale)
-            except Exception as e:
-                print(f"Warning: Could not apply formatting to sheet '{sheet_name}': {str(e)}")
-                
-        wb.save(path)
-
-    def update_quality_report(self, unit_no, dataframes):
+    def update_quality_report(self, unit_no, dataframes, max_daily_rows=MAX_DAILY_ROWS):
         '''
-        Update the quality report with the new data
+        Save the new percentages to the store and render the xlsx report from them
+
+        param: max_daily_rows: int: keep at most this many days in the daily sheets, None keeps all
         '''
+        with Metrics.stage("store", unit_no):
+            self.store.save(unit_no, dataframes)
         daily, monthly = dataframes
         if not os.path.exists(f'quality_reports/'):
             os.makedirs(f'quality_reports/')
         path = f'quality_reports/UNIT {unit_no} REPORT.xlsx'
-        with pd.ExcelWriter(path) as writer:
-            bad_df_daily, missing_df_daily = daily
-            bad_df_daily.to_excel(writer, sheet_name='Daily Bad Values')
-            missing_df_daily.to_excel(writer, sheet_name='Daily Missing Values')
-            bad_df_monthly, missing_df_monthly = monthly
-            bad_df_monthly.to_excel(writer, sheet_name='Monthly Bad Values')
-            missing_df_monthly.to_excel(writer, sheet_name='Monthly Missing Values')
-        try:
-            self._format_quality_result(path)
-        except Exception as e:
-            print(f"Error formatting quality report: {str(e)}")
+        bad_df_daily, missing_df_daily = daily
+        bad_df_monthly, missing_df_monthly = monthly
+        with Metrics.stage("write_report", unit_no):
+            # Data and color scale are written in one pass, the file is never reopened
+            write_report(path, {
+                'Daily Bad Values': window_rows(bad_df_daily, max_daily_rows, f'{ARCHIVE_PATH}/UNIT {unit_no} Daily Bad Values.csv'),
+                'Daily Missing Values': window_rows(missing_df_daily, max_daily_rows, f'{ARCHIVE_PATH}/UNIT {unit_no} Daily Missing Values.csv'),
+                'Monthly Bad Values': bad_df_monthly,
+                'Monthly Missing Values': missing_df_monthly
+            })
         print(f'Quality report for unit {unit_no} updated')
 
         return
     
     def combine_quality_reports(self, unit_path):
         '''
-        Combine the quality reports into one file
+        Combine the monthly missing values of all units into one file, one sheet per fleet column.
+        Units are read from the quality store in one query; units the store has not seen are bootstrapped
+        from their xlsx report in unit_path first.
         '''
-        elec_df = pd.DataFrame()
-        gas_df = pd.DataFrame()
-        
+        stored = set(self.store.units())
         for unit in self.units:
-            unit_no = unit.unit_no
-            path = f'{unit_path}/UNIT {unit_no} REPORT.xlsx'
-            if os.path.exists(path):
-                try:
-                    with pd.ExcelFile(path) as xls:
-                        if 'Monthly Missing Values' in xls.sheet_names:
-                            df = pd.read_excel(xls, 'Monthly Missing Values', index_col=0)
-                            elec = df['Total Electricity']
-                            elec_df[unit_no] = elec
-                            try:
-                                gas = df['Gas']
-                                gas_df[unit_no] = gas
-                            except:
-                                continue
-                except Exception as e:
-                    print(f"Error reading report for unit {unit_no}: {str(e)}")
-        # Align all DataFrames to a common index (union of all dates)
-        # combined_index = elec_df.index.union(gas_df.index)
-        # elec_df = elec_df.reindex(combined_index, fill_value=100)
-        # gas_df = gas_df.reindex(combined_index, fill_value=100)
-        # Save combined reports
+            path = f'{unit_path}/UNIT {unit.unit_no} REPORT.xlsx'
+            if unit.unit_no not in stored and os.path.exists(path):
+                self._load_quality_report(unit, path)
+        combined = self.store.load_fleet('monthly', 'missing', list(FLEET_SHEETS.values()))
+        sheets = {}
+        for sheet_name, column in FLEET_SHEETS.items():
+            sheets[sheet_name] = combined[column] if column in combined.columns.get_level_values(0) else pd.DataFrame()
         save_path = f'{unit_path}/Combined Quality Report.xlsx'
-        with pd.ExcelWriter(save_path) as writer:
-            elec_df.to_excel(writer, sheet_name='Monthly Electricity')
-            gas_df.to_excel(writer, sheet_name='Monthly Gas')
-        self._format_quality_result(save_path)
+        write_report(save_path, sheets)
         print(f'Combined quality reports saved to {unit_path}')
         return
                     
-def main():
+def main(metrics: bool = False, prometheus: bool = False, memory: bool = False):
+    # When called from monthly.py the monthly run is already being instrumented
+    metrics = metrics or memory
+    if metrics:
+        Metrics.start("quality", memory=memory)
     checker = QualityChecker()
-    for unit in block_1+block_3:
-        dataframes = checker.check_data_quality(unit)
-        checker.update_quality_report(unit, dataframes)
+    for unit in checker.units:
+        dataframes = checker.check_data_quality(unit.unit_no)
+        checker.update_quality_report(unit.unit_no, dataframes)
+    if metrics:
+        Metrics.finish(prometheus)
 
 
 if __name__ == "__main__":
@@ -287,4 +242,6 @@ if __name__ == "__main__":
     # dataframes = checker.check_data_quality(2806)
     # checker.update_quality_report(2806, dataframes)
     # checker.combine_quality_reports('quality_reports')
-    main()
+    # --memory adds per-stage peak memory and the top allocation sites to the metrics, the run is slower
+    main(metrics='--metrics' in sys.argv or '--prometheus' in sys.argv, prometheus='--prometheus' in sys.argv,
+         memory='--memory' in sys.argv)
@@ -0,0 +1,169 @@
+import os
+import sqlite3
+import pandas as pd
+
+STORE_PATH = 'quality_reports/quality.sqlite'
+SHEETS = [
+    ('daily', 'bad'),
+    ('daily', 'missing'),
+    ('monthly', 'bad'),
+    ('monthly', 'missing')
+]
+ROLLUP_COLUMNS = ['resolution', 'period', 'channel', 'min', 'max', 'mean', 'sum', 'count', 'bad', 'missing']
+
+class QualityStore:
+    '''
+    Bad/missing percentages per unit, channel and period in SQLite.
+    This is the source of truth for QualityChecker; the xlsx reports are rendered from it.
+    The rollups table holds hourly and daily min/max/mean/sum/count and bad/missing minute counts of
+    each monitored channel, so reports and long-range queries do not rescan minute data.
+    '''
+    def __init__(self, path: str = STORE_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS quality (
+                    unit_no INTEGER NOT NULL,
+                    period_type TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    period TEXT NOT NULL,
+                    channel TEXT NOT NULL,
+                    value REAL,
+                    PRIMARY KEY (unit_no, period_type, metric, period, channel)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rollups (
+                    unit_no INTEGER NOT NULL,
+                    resolution TEXT NOT NULL,
+                    period TEXT NOT NULL,
+                    channel TEXT NOT NULL,
+                    min REAL,
+                    max REAL,
+                    mean REAL,
+                    sum REAL,
+                    count INTEGER NOT NULL,
+                    bad INTEGER NOT NULL,
+                    missing INTEGER NOT NULL,
+                    PRIMARY KEY (unit_no, resolution, period, channel)
+                ) WITHOUT ROWID
+            ''')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def has_unit(self, unit_no) -> bool:
+        with self._connect() as conn:
+            return conn.execute('SELECT 1 FROM quality WHERE unit_no = ? LIMIT 1', (int(unit_no),)).fetchone() is not None
+
+    def units(self) -> list[int]:
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute('SELECT DISTINCT unit_no FROM quality ORDER BY unit_no')]
+
+    def load_metric(self, unit_no, period_type: str, metric: str, columns: list = None) -> pd.DataFrame:
+        '''
+        Load one sheet worth of percentages
+
+        param: unit_no: int: unit number
+        param: period_type: str: 'daily' or 'monthly'
+        param: metric: str: 'bad' or 'missing'
+        param: columns: list[str]: columns to always include, in order (e.g. the monitored channels)
+        return: pd.DataFrame: periods x channels
+        '''
+        with self._connect() as conn:
+            rows = pd.read_sql_query(
+                'SELECT period, channel, value FROM quality WHERE unit_no = ? AND period_type = ? AND metric = ?',
+                conn, params=(int(unit_no), period_type, metric))
+        df = rows.pivot(index='period', columns='channel', values='value') if not rows.empty else pd.DataFrame()
+        df.index.name = None
+        df.columns.name = None
+        columns = list(columns or [])
+        df = df.reindex(columns=columns + [column for column in df.columns if column not in columns])
+        return df.sort_index().astype(float)
+
+    def load(self, unit_no, columns: list = None):
+        '''
+        Load all four sheets for a unit
+
+        return: tuple: (bad_df_daily, missing_df_daily, bad_df_monthly, missing_df_monthly)
+        '''
+        return tuple(self.load_metric(unit_no, period_type, metric, columns) for period_type, metric in SHEETS)
+
+    def load_fleet(self, period_type: str, metric: str, channels: list) -> pd.DataFrame:
+        '''
+        Load one metric of some channels for all units, aligned to one period index
+
+        param: period_type: str: 'daily' or 'monthly'
+        param: metric: str: 'bad' or 'missing'
+        param: channels: list[str]: channels to load, e.g. the derived 'Total Electricity' and 'Gas' columns
+        return: pd.DataFrame: periods x (channel, unit_no) columns
+        '''
+        with self._connect() as conn:
+            rows = pd.read_sql_query(
+                f'SELECT unit_no, channel, period, value FROM quality WHERE period_type = ? AND metric = ? AND channel IN ({", ".join("?" * len(channels))})',
+                conn, params=[period_type, metric] + list(channels))
+        df = rows.pivot(index='period', columns=['channel', 'unit_no'], values='value')
+        df.index.name = None
+        return df.sort_index(axis=0).sort_index(axis=1)
+
+    def save(self, unit_no, dataframes):
+        '''
+        Insert or update the percentages of a unit
+
+        param: dataframes: tuple: ((bad_df_daily, missing_df_daily), (bad_df_monthly, missing_df_monthly))
+        '''
+        (bad_df_daily, missing_df_daily), (bad_df_monthly, missing_df_monthly) = dataframes
+        rows = []
+        for (period_type, metric), df in zip(SHEETS, [bad_df_daily, missing_df_daily, bad_df_monthly, missing_df_monthly]):
+            if df.empty:
+                continue
+            long = df.apply(pd.to_numeric, errors='coerce').stack().dropna()
+            rows += [(int(unit_no), period_type, metric, str(period), str(channel), float(value)) for (period, channel), value in long.items()]
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO quality VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def save_rollups(self, unit_no, rollups: pd.DataFrame):
+        '''
+        Insert or update rollup rows of a unit
+
+        param: rollups: pd.DataFrame: rows with the ROLLUP_COLUMNS columns, see rollup.summarize_minutes
+        '''
+        if rollups.empty:
+            return
+        rows = rollups[ROLLUP_COLUMNS].astype(object).where(rollups[ROLLUP_COLUMNS].notna(), None)
+        with self._connect() as conn:
+            conn.executemany(f'INSERT OR REPLACE INTO rollups VALUES (?, {", ".join("?" * len(ROLLUP_COLUMNS))})',
+                             [(int(unit_no),) + tuple(row) for row in rows.itertuples(index=False, name=None)])
+
+    def load_rollups(self, unit_no, resolution: str, start: str = None, end: str = None, channels: list = None) -> pd.DataFrame:
+        '''
+        Load rollup rows of a unit
+
+        param: resolution: str: 'hour' or 'day'
+        param: start: str: first period to load, e.g. '2025-01-01' or '2025-01-01 00:00', None for no limit
+        param: end: str: last period to load, inclusive, None for no limit
+        param: channels: list[str]: channels to load, None for all
+        return: pd.DataFrame: rows with the ROLLUP_COLUMNS columns sorted by period
+        '''
+        query = f'SELECT {", ".join(ROLLUP_COLUMNS)} FROM rollups WHERE unit_no = ? AND resolution = ?'
+        params = [int(unit_no), resolution]
+        if start is not None:
+            query += ' AND period >= ?'
+            params.append(str(start))
+        if end is not None:
+            query += ' AND period <= ?'
+            params.append(str(end))
+        if channels is not None:
+            query += f' AND channel IN ({", ".join("?" * len(channels))})'
+            params += list(channels)
+        with self._connect() as conn:
+            return pd.read_sql_query(query + ' ORDER BY period, channel', conn, params=params)
+
+    def rollup_periods(self, unit_no, resolution: str) -> set:
+        '''
+        Periods of a unit that have rollups, e.g. the days already summarized
+        '''
+        with self._connect() as conn:
+            return {row[0] for row in conn.execute('SELECT DISTINCT period FROM rollups WHERE unit_no = ? AND resolution = ?', (int(unit_no), resolution))}
@@ -0,0 +1,160 @@
+import os
+import re
+import sys
+import json
+import argparse
+from bisect import bisect_right
+import numpy as np
+import pandas as pd
+from channels import channels
+from storage import is_csv
+
+MINUTE_PATH = './Minute_Data'
+INDEX_FILE = 'index.json' # Time index sidecar kept in each unit's Minute_Data folder
+INDEX_STRIDE = 60 # Rows between checkpoints in the time index, one per hour of minute data
+
+def _index_file(path: str) -> dict:
+    '''
+    Time index entry of one minute file: its columns, row count and the timestamp of every INDEX_STRIDE-th row
+    '''
+    columns = list(pd.read_csv(path, nrows=0).columns)
+    timestamps = pd.to_datetime(pd.read_csv(path, usecols=[0]).iloc[:, 0], errors='coerce')
+    checkpoints = timestamps.iloc[::INDEX_STRIDE]
+    return {
+        "columns": columns,
+        "rows": len(timestamps),
+        "start": str(timestamps.min()),
+        "end": str(timestamps.max()),
+        "checkpoints": [str(ts) for ts in checkpoints],
+        "sorted": bool(timestamps.is_monotonic_increasing and not timestamps.isna().any())
+    }
+
+def load_index(unit_no, minute_path: str = MINUTE_PATH) -> dict:
+    '''
+    Load the time index of a unit's minute files, (re)indexing files that are new or changed since the last call
+
+    param: unit_no: int: unit number
+    param: minute_path: str: root of the stored minute data
+    return: dict[str, dict]: file name -> index entry
+    '''
+    unit_dir = os.path.join(minute_path, f'UNIT {unit_no}')
+    if not os.path.isdir(unit_dir):
+        return {}
+    index_path = os.path.join(unit_dir, INDEX_FILE)
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        index = {}
+    changed = False
+    files = [file for file in os.listdir(unit_dir) if is_csv(file)]
+    for file in files:
+        stat = os.stat(os.path.join(unit_dir, file))
+        entry = index.get(file)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            continue
+        try:
+            entry = _index_file(os.path.join(unit_dir, file))
+        except (ValueError, pd.errors.ParserError, pd.errors.EmptyDataError, OSError) as e:
+            print(f"Could not index {file}: {str(e)}")
+            continue
+        entry["size"] = stat.st_size
+        entry["mtime"] = stat.st_mtime_ns
+        index[file] = entry
+        changed = True
+    for file in set(index) - set(files):
+        del index[file]
+        changed = True
+    if changed:
+        tmp_path = f'{index_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    return index
+
+def resolve_channel(name: str, columns: list) -> int:
+    '''
+    Find the column of a channel, by its channels.py name (case-insensitive) or by exact column name
+
+    return: int: position of the column, None if the file does not have it
+    '''
+    for channel_name, channel in channels.items():
+        if channel_name.lower() == name.lower():
+            for position, column in enumerate(columns):
+                if position > 0 and re.search(channel.regex, column):
+                    return position
+            return None
+    return columns.index(name) if name in columns[1:] else None
+
+def _row_range(entry: dict, start: pd.Timestamp, end: pd.Timestamp):
+    '''
+    Rows of a sorted file that can hold timestamps in [start, end], from its checkpoints
+
+    return: tuple[int, int]: first row and number of rows to read
+    '''
+    if not entry["sorted"]:
+        return 0, entry["rows"]
+    checkpoints = [pd.Timestamp(ts) for ts in entry["checkpoints"]]
+    first = max(bisect_right(checkpoints, start) - 1, 0) * INDEX_STRIDE
+    last = min(bisect_right(checkpoints, end) * INDEX_STRIDE, entry["rows"])
+    return first, max(last - first, 0)
+
+def query(unit_no, channel_names, start, end, minute_path: str = MINUTE_PATH) -> pd.DataFrame:
+    '''
+    Read stored minute data of one unit for some channels and a time range.
+    Only files overlapping the range are opened, and only the rows between the surrounding index
+    checkpoints and the requested columns are parsed.
+
+    param: unit_no: int: unit number
+    param: channel_names: str or list[str]: channels.py names (e.g. "Hot Water Avg C") or column names
+    param: start: str or datetime: start of the range, inclusive
+    param: end: str or datetime: end of the range, inclusive
+    return: pd.DataFrame: float32 columns indexed by Date, empty if nothing is stored for the range
+    '''
+    if isinstance(channel_names, str):
+        channel_names = [channel_names]
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    unit_dir = os.path.join(minute_path, f'UNIT {unit_no}')
+    frames = []
+    for file, entry in sorted(load_index(unit_no, minute_path).items()):
+        if pd.Timestamp(entry["end"]) < start or pd.Timestamp(entry["start"]) > end:
+            continue
+        positions = [resolve_channel(name, entry["columns"]) for name in channel_names]
+        positions = sorted({position for position in positions if position is not None})
+        if not positions:
+            continue
+        first, nrows = _row_range(entry, start, end)
+        if nrows == 0:
+            continue
+        df = pd.read_csv(os.path.join(unit_dir, file), usecols=[0] + positions,
+                         skiprows=range(1, first + 1), nrows=nrows)
+        df = df.set_index(pd.to_datetime(df.iloc[:, 0], errors='coerce')).iloc[:, 1:]
+        df.index.name = 'Date'
+        frames.append(df[(df.index >= start) & (df.index <= end)])
+    if not frames:
+        return pd.DataFrame()
+    data = pd.concat(frames).sort_index()
+    data = data[~data.index.duplicated(keep='first')]
+    return data.apply(pd.to_numeric, errors='coerce').astype(np.float32)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query stored minute data, e.g. python query.py 2806 "Hot Water Avg C" "2025-01-12 02:00" "2025-01-12 04:00"')
+    parser.add_argument('unit', type=int, help='unit number')
+    parser.add_argument('channel', nargs='+', help='channel names from channels.py or column names')
+    parser.add_argument('start', help='start of the range, e.g. "2025-01-12 02:00"')
+    parser.add_argument('end', help='end of the range, e.g. "2025-01-12 04:00"')
+    parser.add_argument('--path', default=MINUTE_PATH, help='minute data folder')
+    parser.add_argument('--csv', action='store_true', help='print csv instead of a table')
+    args = parser.parse_args(argv)
+    data = query(args.unit, args.channel, args.start, args.end, args.path)
+    if data.empty:
+        print(f"No data for unit {args.unit} between {args.start} and {args.end}")
+        return
+    if args.csv:
+        data.to_csv(sys.stdout)
+    else:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', None):
+            print(data)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import os
+import json
+import difflib
+import threading
+from unit import Unit
+from channels import channels
+
+CONFIG_PATH = 'config/'
+REQUIRED_KEYS = ['unit_no', 'block', 'ip_address', 'port', 'serial', 'channels']
+
+class UnitRegistry:
+    '''
+    Unit configs from config/*.json, parsed and validated once and reloaded only when a file changes.
+    Every entry point gets fresh Unit objects built from the same cached configs and check plans, where the
+    check plan of a unit is the tuple of its enabled channels.
+    '''
+    _registries = {}
+    _lock = threading.Lock()
+
+    def __init__(self, config_path: str = CONFIG_PATH):
+        self.config_path = config_path
+        self._mtimes = {} # file -> mtime_ns of the parsed version
+        self._files = {} # file -> parsed config
+        self._configs = {} # unit_no -> config
+        self._plans = {} # unit_no -> enabled channels
+
+    @staticmethod
+    def get(config_path: str = CONFIG_PATH) -> 'UnitRegistry':
+        '''
+        Registry shared by everything in the process that loads the same config folder
+        '''
+        with UnitRegistry._lock:
+            key = os.path.abspath(config_path)
+            if key not in UnitRegistry._registries:
+                UnitRegistry._registries[key] = UnitRegistry(config_path)
+            return UnitRegistry._registries[key]
+
+    @staticmethod
+    def validate(config: dict, file: str = ''):
+        '''
+        Raise ValueError if a unit config is missing keys or has channels that are not in channels.py
+
+        param: config: dict: parsed unit config
+        param: file: str: file name used in the error message
+        '''
+        missing = [key for key in REQUIRED_KEYS if key not in config]
+        if missing:
+            raise ValueError(f"{file}: missing keys {missing}")
+        if not isinstance(config.get('drive_folder', ''), str):
+            raise ValueError(f"{file}: drive_folder must be a Google Drive folder id")
+        if not isinstance(config['channels'], dict):
+            raise ValueError(f"{file}: channels must be an object of channel name -> true/false")
+        problems = []
+        for channel, enabled in config['channels'].items():
+            if channel not in channels:
+                suggestion = difflib.get_close_matches(channel, list(channels), n=1)
+                problems.append(f"unknown channel '{channel}'" + (f", did you mean '{suggestion[0]}'?" if suggestion else ""))
+            elif not isinstance(enabled, bool):
+                problems.append(f"channel '{channel}' must be true or false, not {enabled!r}")
+        if problems:
+            raise ValueError(f"{file} (unit {config['unit_no']}): " + "; ".join(problems))
+
+    def reload(self):
+        '''
+        Parse and validate config files that are new or changed since the last call, and drop removed ones
+        '''
+        with UnitRegistry._lock:
+            files = sorted(file for file in os.listdir(self.config_path) if file.endswith('.json'))
+            mtimes = {file: os.stat(os.path.join(self.config_path, file)).st_mtime_ns for file in files}
+            if mtimes == self._mtimes:
+                return
+            parsed = {}
+            for file in files:
+                if self._mtimes.get(file) == mtimes[file]:
+                    parsed[file] = self._files[file]
+                    continue
+                with open(os.path.join(self.config_path, file), 'r') as f:
+                    try:
+                        config = json.load(f)
+                    except json.JSONDecodeError as e:
+                        raise ValueError(f"{file}: invalid JSON: {str(e)}")
+                self.validate(config, file)
+                parsed[file] = config
+            configs = {}
+            for file, config in parsed.items():
+                if config['unit_no'] in configs:
+                    raise ValueError(f"{file}: unit {config['unit_no']} is configured more than once")
+                configs[config['unit_no']] = config
+            self._files, self._mtimes, self._configs = parsed, mtimes, configs
+            self._plans = {unit_no: tuple(channel for channel, enabled in config['channels'].items() if enabled)
+                           for unit_no, config in configs.items()}
+
+    def _build(self, config: dict) -> Unit:
+        return Unit(config['unit_no'], config['block'], config['ip_address'], config['port'], config['serial'],
+                    config['channels'], plan=self._plans[config['unit_no']])
+
+    def units(self) -> list[Unit]:
+        '''
+        return: list[Unit]: a new Unit for every configured unit, sorted by unit number
+        '''
+        self.reload()
+        return sorted(self._build(config) for config in self._configs.values())
+
+    def unit(self, unit_no) -> Unit:
+        '''
+        return: Unit: a new Unit for one unit number, raises KeyError if it is not configured
+        '''
+        self.reload()
+        if unit_no not in self._configs:
+            raise KeyError(f"Unit {unit_no} is not configured in {self.config_path}")
+        return self._build(self._configs[unit_no])
+
+    def plan(self, unit_no) -> tuple:
+        '''
+        return: tuple[str]: enabled channels of a unit, in config order
+        '''
+        self.reload()
+        return self._plans[unit_no]
+
+    def drive_folder(self, unit_no):
+        '''
+        return: str: Google Drive folder id the unit's combined files are uploaded to, None if the unit or the
+        optional drive_folder key is not configured
+        '''
+        self.reload()
+        return self._configs.get(unit_no, {}).get('drive_folder')
+
+    def unit_numbers(self) -> list[int]:
+        self.reload()
+        return sorted(self._configs)
@@ -0,0 +1,70 @@
+import os
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.formatting.rule import ColorScaleRule
+from openpyxl.utils import get_column_letter
+
+ARCHIVE_PATH = 'quality_reports/archive'
+
+def _cell(value):
+    '''
+    Convert a DataFrame value to something openpyxl writes as a plain cell
+    '''
+    if value is None or (isinstance(value, float) and np.isnan(value)) or value is pd.NaT:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+        if isinstance(value, float) and np.isnan(value):
+            return None
+    return value
+
+def write_report(path: str, sheets: dict, color_scale: bool = True):
+    '''
+    Write DataFrames to an xlsx file in one streaming pass (openpyxl write-only mode), adding the
+    white-to-red 0-100 color scale to each sheet's data range as it is written.
+    The file is written next to the target and renamed so a failed write never leaves a broken report.
+
+    param: path: str: path of the xlsx file
+    param: sheets: dict[str, pd.DataFrame]: sheet name -> data, the index is written as the first column
+    param: color_scale: bool: add the color scale to the data range of each sheet
+    '''
+    workbook = Workbook(write_only=True)
+    for sheet_name, df in sheets.items():
+        sheet = workbook.create_sheet(sheet_name)
+        sheet.append([df.index.name] + [str(column) for column in df.columns])
+        for index, row in zip(df.index, df.itertuples(index=False, name=None)):
+            sheet.append([_cell(index)] + [_cell(value) for value in row])
+        if color_scale and len(df) > 0 and len(df.columns) > 0:
+            sheet.conditional_formatting.add(
+                f"B2:{get_column_letter(len(df.columns) + 1)}{len(df) + 1}",
+                ColorScaleRule(
+                    start_type="num", start_value=0, start_color="FFFFFFFF",  # White for 0
+                    end_type="num", end_value=100, end_color="FFFF0000"      # Red for 100
+                )
+            )
+    tmp_path = f'{path}.tmp.xlsx'
+    workbook.save(tmp_path)
+    os.replace(tmp_path, path)
+
+def window_rows(df: pd.DataFrame, max_rows: int, archive_file: str) -> pd.DataFrame:
+    '''
+    Keep the last max_rows rows of a daily sheet and move older rows to a CSV archive
+
+    param: df: pd.DataFrame: daily sheet indexed by date
+    param: max_rows: int: rows to keep, None keeps everything
+    param: archive_file: str: CSV file the older rows are merged into
+    return: pd.DataFrame: the windowed sheet
+    '''
+    if max_rows is None or len(df) <= max_rows:
+        return df
+    df = df.sort_index()
+    old, recent = df.iloc[:-max_rows], df.iloc[-max_rows:]
+    os.makedirs(os.path.dirname(archive_file), exist_ok=True)
+    if os.path.exists(archive_file):
+        archived = pd.read_csv(archive_file, index_col=0)
+        archived.index = archived.index.astype(str)
+        old = pd.concat([archived, old])
+        old = old[~old.index.duplicated(keep='last')].sort_index()
+    old.to_csv(archive_file)
+    return recent
@@ -0,0 +1,205 @@
+import os
+import re
+import calendar
+import numpy as np
+import pandas as pd
+from unit import Unit
+from log import Log
+from color import color
+from metrics import Metrics
+from storage import is_csv
+from channels import channels, is_summed
+
+MINUTE_PATH = './Minute_Data'
+MIN_MINUTES_PER_HOUR = 45 # Hours with fewer stored minutes are taken from the dashbox export instead
+MINUTES_PER_HOUR = 60 # Sums of hours with fewer stored minutes are scaled up, or taken from the export when it is downloaded
+RECONCILE_RTOL = 0.05 # Relative tolerance between the rollup and the dashbox export
+RECONCILE_ATOL = 1.0 # Absolute tolerance, so near-zero channels do not trip the relative check
+# Rollup resolutions of summarize_minutes: pandas frequency, expected minutes and period format
+RESOLUTIONS = {
+    'hour': ('h', 60, '%Y-%m-%d %H:00'),
+    'day': ('D', 1440, '%Y-%m-%d')
+}
+
+def _aggregation(column: str) -> str:
+    '''
+    Energy and pulse columns are per-minute amounts and are summed, everything else is averaged
+    '''
+    if is_summed(column):
+        return 'sum'
+    return 'mean'
+
+def load_minute_month(unit: Unit, month: str, minute_path: str = MINUTE_PATH) -> pd.DataFrame:
+    '''
+    Load the stored minute files of one unit for a month
+
+    param: unit: Unit: unit to load
+    param: month: str: month in YYYY-MM format
+    return: pd.DataFrame: minute data indexed by timestamp, empty if nothing is stored
+    '''
+    path = os.path.join(minute_path, f'UNIT {unit.unit_no}')
+    if not os.path.isdir(path):
+        return pd.DataFrame()
+    files = sorted(f for f in os.listdir(path) if f.startswith(f'Unit_{unit.unit_no}_{month}-') and is_csv(f))
+    frames = []
+    for file in files:
+        df = pd.read_csv(os.path.join(path, file), on_bad_lines='skip')
+        # Saved minute files repeat the Date column (Date, Date.1) after check_missing_rows
+        df = df.drop(columns=[column for column in df.columns[1:] if column.startswith('Date') or column == 'Timestamp'])
+        df[df.columns[0]] = pd.to_datetime(df[df.columns[0]], errors='coerce')
+        frames.append(df.dropna(subset=[df.columns[0]]))
+    if not frames:
+        return pd.DataFrame()
+    data = pd.concat(frames, ignore_index=True)
+    data = data.set_index(data.columns[0]).sort_index()
+    data = data[~data.index.duplicated(keep='first')]
+    return data.apply(pd.to_numeric, errors='coerce')
+
+def summarize_minutes(unit: Unit, data: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Summarize checked minute data into hourly and daily rollups of each monitored channel.
+    Bad counts use the channel limits, missing counts are the expected minutes without a finite value.
+
+    param: unit: Unit: unit the data belongs to, its enabled channels are summarized
+    param: data: pd.DataFrame: minute data with the timestamp in the first column
+    return: pd.DataFrame: one row per (resolution, period, channel) with min, max, mean, sum, count, bad and missing
+    '''
+    names, positions = [], []
+    for channel in unit.plan:
+        # re.search rather than str.contains, which warns about the capture groups in most channel regexes
+        pattern = re.compile(channels[channel].regex)
+        matching = [position for position, column in enumerate(data.columns) if position > 0 and pattern.search(str(column))]
+        if len(matching) > 0:
+            names.append(channel)
+            positions.append(matching[0])
+    timestamps = pd.to_datetime(data.iloc[:, 0], errors='coerce')
+    if not names or timestamps.isna().all():
+        return pd.DataFrame()
+    values = data.iloc[:, positions].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    values = pd.DataFrame(values, index=pd.DatetimeIndex(timestamps), columns=names)[timestamps.notna().to_numpy()]
+    values = values[~values.index.duplicated(keep='first')]
+    low = np.array([channels[name].min_value for name in names], dtype=np.float64)
+    high = np.array([channels[name].max_value for name in names], dtype=np.float64)
+    bad = (values < low) | (values > high)
+    finite = values.where(np.isfinite(values))
+
+    frames = []
+    for resolution, (freq, minutes, period_format) in RESOLUTIONS.items():
+        key = values.index.floor(freq)
+        grouped = finite.groupby(key)
+        count = grouped.count()
+        periods, width = count.index.strftime(period_format), len(names)
+        frame = pd.DataFrame({
+            'resolution': resolution,
+            'period': np.repeat(periods, width),
+            'channel': np.tile(names, len(periods)),
+            'min': grouped.min().to_numpy().ravel(),
+            'max': grouped.max().to_numpy().ravel(),
+            'mean': grouped.mean().to_numpy().ravel(),
+            'sum': grouped.sum(min_count=1).to_numpy().ravel(),
+            'count': count.to_numpy().ravel(),
+            'bad': bad.groupby(key).sum().to_numpy().ravel()
+        })
+        frame['missing'] = np.clip(minutes - frame['count'], 0, None)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+def rollup_minutes(minute: pd.DataFrame):
+    '''
+    Roll minute data up to hours in one resample.
+    Sums of partly stored hours are scaled up to the full hour from the minutes each column has.
+
+    return: tuple[pd.DataFrame, pd.Series]: hourly data and the number of stored minutes in each hour
+    '''
+    resampled = minute.resample('h', label='left', closed='left')
+    hourly = resampled.agg({column: _aggregation(column) for column in minute.columns})
+    # Saved minute files have a row for every minute, a stored minute is one with any value
+    counts = minute.notna().any(axis=1).resample('h', label='left', closed='left').sum()
+    summed = [column for column in minute.columns if is_summed(column)]
+    if summed:
+        # A sum over an hour with no values is 0, not a measurement, and becomes NaN here
+        column_counts = resampled[summed].count()
+        hourly[summed] = hourly[summed] * MINUTES_PER_HOUR / column_counts.where(column_counts > 0)
+    hourly[counts == 0] = np.nan
+    return hourly, counts
+
+def reconcile(rollup: pd.DataFrame, export: pd.DataFrame, unit_no) -> list[str]:
+    '''
+    Compare the rollup and the dashbox export on the hours and columns they share
+
+    return: list[str]: one warning per column that disagrees
+    '''
+    hours = rollup.index.intersection(export.index)
+    columns = rollup.columns.intersection(export.columns)
+    if len(hours) == 0 or len(columns) == 0:
+        return []
+    a = rollup.loc[hours, columns].to_numpy(dtype=np.float64)
+    b = export.loc[hours, columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        mismatch = np.abs(a - b) > RECONCILE_ATOL + RECONCILE_RTOL * np.abs(b)
+    warnings = []
+    for column, count in zip(columns, mismatch.sum(axis=0)):
+        if count > 0:
+            message = f"{column.lstrip('0123456789- ')}: rollup differs from dashbox hourly export in {count} of {len(hours)} hours"
+            Log.write(f"Unit {unit_no}: {message}")
+            print(f"{color.YELLOW}Unit {unit_no}: {message}{color.END}")
+            warnings.append(message)
+    return warnings
+
+def rollup_hour_data(unit: Unit, month: str = None, minute_path: str = MINUTE_PATH, download: bool = True) -> bool:
+    '''
+    Build a unit's hourly data for a month from the stored minute data.
+    The dashbox monthly export is only downloaded when the minute store is missing hours or minutes. Hours
+    with fewer than MIN_MINUTES_PER_HOUR stored minutes are taken from it, partly stored hours take only
+    their summed columns from it, and the fully stored hours are used to reconcile against the rollup.
+
+    param: unit: Unit: unit to build hourly data for, unit.data is replaced with the hourly data
+    param: month: str: month in YYYY-MM format, defaults to last month
+    param: download: bool: fall back to the dashbox export for hours the minute store lacks
+    return: bool: True if hourly data is available
+    '''
+    month = month or Unit.last_month
+    with Metrics.stage("rollup", unit.unit_no):
+        minute = load_minute_month(unit, month, minute_path)
+        if minute.empty:
+            hourly, counts = pd.DataFrame(), pd.Series(dtype=int)
+        else:
+            hourly, counts = rollup_minutes(minute)
+    year, month_num = (int(part) for part in month.split('-'))
+    expected = pd.date_range(f'{month}-01', periods=calendar.monthrange(year, month_num)[1] * 24, freq='h')
+    complete = counts[counts >= MIN_MINUTES_PER_HOUR].index
+    full = counts[counts >= MINUTES_PER_HOUR].index
+    missing_hours = expected.difference(complete)
+    partial_hours = complete.difference(full)
+    Metrics.add("rows_parsed", len(minute), unit.unit_no)
+
+    if (len(missing_hours) > 0 or len(partial_hours) > 0) and download:
+        message = f"Unit {unit.unit_no}: {len(missing_hours)} hours missing and {len(partial_hours)} partly stored in minute data, downloading hourly export"
+        print(message)
+        Log.write(message)
+        unit.download_hour_data(month)
+        if unit.data is not None:
+            export = unit.data.copy()
+            export = export.set_index(pd.to_datetime(export.iloc[:, 0], errors='coerce')).iloc[:, 1:]
+            export = export[~export.index.duplicated(keep='first')]
+            unit.warnings += reconcile(hourly.loc[full], export, unit.unit_no)
+            hourly = hourly.loc[complete]
+            # The scaled sums of partly stored hours are estimates, the export has the dashbox's totals
+            hours = partial_hours.intersection(export.index)
+            summed = [column for column in hourly.columns.intersection(export.columns) if is_summed(column)]
+            if len(hours) > 0 and summed:
+                hourly.loc[hours, summed] = export.loc[hours, summed].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+            fill = export.loc[export.index.intersection(missing_hours)].apply(pd.to_numeric, errors='coerce')
+            hourly = pd.concat([hourly, fill]).sort_index()
+        else:
+            hourly = hourly.loc[complete]
+    else:
+        hourly = hourly.loc[complete] if not hourly.empty else hourly
+
+    unit.datatype = "Hour"
+    if hourly.empty:
+        unit.data = None
+        return False
+    hourly.index.name = 'Date'
+    unit.data = hourly.reset_index()
+    return True
@@ -9,6 +9,12 @@ Log error format:
 Unit {unit_no}: {date}, Index {index}: {error_message}
 '''
 
+# Columns used by check_total_energy to balance generated against consumed power
+MAIN_ELEC_REGEX = 'Main\\s*Electricity(?!\\s*Gen).*(Watts)$'
+PV_REGEX = "PV.*(Watts)$"
+ELEC_REGEX = "^(?!.*Gen\\s).*(Watts)$"
+ENERGY_REGEXES = [MAIN_ELEC_REGEX, PV_REGEX, ELEC_REGEX]
+
 # Function to increment a given time string by a specified number of minutes
 def increment_time(time: str, minutes: int = 1) -> str:
     time_format = "%Y-%m-%d %H:%M:%S"
@@ -60,6 +66,16 @@ def find_time_step(initial_time, second_time, unit_no) -> int:
     
     return time_step
 
+def time_step_minutes(data: pd.DataFrame) -> int:
+    '''
+    Minutes between samples (1 for minute data, 60 for hourly data) from the median spacing of the
+    timestamps in the first column, 1 if it cannot be told
+    '''
+    timestamps = pd.to_datetime(data.iloc[:, 0], errors='coerce').dropna().to_numpy()
+    if len(timestamps) < 2:
+        return 1
+    return max(int(round(np.median(np.abs(np.diff(timestamps))) / np.timedelta64(1, 'm'))), 1)
+
 # Function to check for missing rows in a DataFrame and log errors
 def check_missing_rows(data: pd.DataFrame, unit_no):
     errors = []
@@ -112,10 +128,10 @@ def check_total_energy(data, unit_no):
 
     # iterate through data rows
     for index, row in data.iterrows():
-        main_elec_cols = row.filter(regex='Main\\s*Electricity(?!\\s*Gen).*(Watts)$')
-        pv_cols = row.filter(regex="PV.*(Watts)$")
+        main_elec_cols = row.filter(regex=MAIN_ELEC_REGEX)
+        pv_cols = row.filter(regex=PV_REGEX)
         energy_generated = pd.to_numeric(main_elec_cols).sum(skipna=True) + pd.to_numeric(pv_cols).sum(skipna=True)        
-        elec_cols = row.filter(regex="^(?!.*Gen\\s).*(Watts)$")
+        elec_cols = row.filter(regex=ELEC_REGEX)
         energy_consumed = pd.to_numeric(elec_cols).sum(skipna=True) - energy_generated
 
         # Round the energy values to 2 decimal places
@@ -226,4 +242,176 @@ def check_water_pulse(regex, data, min_limit, max_limit, unit_no, bad_indices):
         activity_errors, activity_warnings = check_activity(regex, data, unit_no)
         errors += activity_errors
         warnings += activity_warnings
-    return errors, warnings
\ No newline at end of file
+    return errors, warnings
+
+# Vectorized checks. Each takes a 2-D float array with one column per channel (NaN where a value is missing),
+# the limits of each column (broadcast across rows) and a mask of rows to skip, and returns flag arrays for
+# Channel.check_channels to turn into the same messages the scalar checks produce.
+
+def _run_counts(flags, resets):
+    '''
+    Running count of flags per column since the last reset row, like the counters in check_limits
+    '''
+    counts = np.cumsum(flags, axis=0)
+    # Counts only grow, so the running maximum of the counts at reset rows is the count at the last reset
+    return counts - np.maximum.accumulate(np.where(resets, counts, 0), axis=0)
+
+def limit_flags(values, min_values, max_values, skip):
+    '''
+    Vectorized check_limits
+
+    param: values: np.ndarray: rows x channels float array
+    param: min_values: np.ndarray: lower limit of each channel
+    param: max_values: np.ndarray: upper limit of each channel
+    param: skip: np.ndarray: rows to skip (bad indices), they neither count nor reset the counters
+    return: dict[str, np.ndarray]: missing and limit masks, and the running counts of each since the last in-limit value
+    '''
+    keep = ~skip[:, None]
+    missing = np.isnan(values) & keep
+    with np.errstate(invalid='ignore'):
+        limit = ((values < min_values) | (values > max_values)) & keep
+    ok = keep & ~missing & ~limit
+    return {
+        "missing": missing,
+        "missing_count": _run_counts(missing, ok),
+        "limit": limit,
+        "limit_count": _run_counts(limit, ok)
+    }
+
+def pulse_flags(values, min_values, max_values, skip):
+    '''
+    Vectorized check_pulse: limits, and channels that sum to zero over the day
+    '''
+    flags = limit_flags(values, min_values, max_values, skip)
+    flags["inactive"] = np.nansum(values, axis=0) == 0
+    return flags
+
+def water_pulse_flags(values, min_values, max_values, skip):
+    '''
+    Vectorized check_water_pulse: limits, and channels that sum to zero although their range is over 5
+    '''
+    flags = limit_flags(values, min_values, max_values, skip)
+    kept = np.where(skip[:, None], np.nan, values)
+    # fmax/fmin ignore NaN, an all-NaN column has no range and is not checked for activity
+    if len(kept) == 0:
+        diff = np.full(values.shape[1], np.nan)
+    else:
+        diff = np.abs(np.fmax.reduce(kept, axis=0) - np.fmin.reduce(kept, axis=0))
+    flags["inactive"] = (diff > 5) & (np.nansum(values, axis=0) == 0)
+    return flags
+
+# Rolling-window checks. Each runs in linear time using run lengths or cumulative sums over the column.
+FLATLINE_MINUTES = 720 # Temperatures are reported in 0.5 C steps and can sit still for several hours, scaled to the time step
+RATE_FRACTION = 0.5 # Largest allowed change between two samples, as a fraction of the channel's range
+SPIKE_WINDOW = 30 # Trailing samples used for the rolling mean and standard deviation
+SPIKE_Z = 6 # Rolling z-score above which a sample is a spike
+SPIKE_MIN_STD = 0.02 # Floor for the rolling standard deviation, as a fraction of the channel's range
+
+def _column_values(regex, data, bad_indices):
+    '''
+    Find the column matching regex and return its values as float64 with bad indices masked out
+
+    return: tuple[str, np.ndarray] or None if the column is not found
+    '''
+    columns = data.filter(regex=regex).columns
+    if len(columns) == 0:
+        return None
+    values = pd.to_numeric(data[columns[0]], errors='coerce').to_numpy(dtype=np.float64, copy=True)
+    if len(bad_indices) > 0:
+        values[np.asarray(bad_indices, dtype=int)] = np.nan
+    return columns[0].lstrip("0123456789- "), values
+
+def _rolling_mean_std(values: np.ndarray, window: int):
+    '''
+    Mean and standard deviation of the previous window samples (excluding the current one), ignoring NaN
+
+    return: tuple[np.ndarray, np.ndarray]: rolling mean and standard deviation, NaN where no samples
+    '''
+    valid = ~np.isnan(values)
+    # Centre on the median before summing squares to avoid cancellation over a month of data
+    centre = np.nanmedian(values) if valid.any() else 0.0
+    centred = np.where(valid, values - centre, 0.0)
+    sums = np.concatenate(([0.0], np.cumsum(centred)))
+    squares = np.concatenate(([0.0], np.cumsum(centred * centred)))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    end = np.arange(len(values))
+    start = np.maximum(end - window, 0)
+    n = counts[end] - counts[start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (sums[end] - sums[start]) / n
+        var = (squares[end] - squares[start]) / n - mean * mean
+    return mean + centre, np.sqrt(np.maximum(var, 0))
+
+def _report_flags(flags, data, unit_no, column_name, describe, max_warnings=2):
+    '''
+    Log flagged indices, the first max_warnings as warnings and the rest as errors (same as check_limits)
+    '''
+    errors, warnings = [], []
+    for count, index in enumerate(flags):
+        message = f"{data.iloc[index, 0]} Index {index}: {column_name} {describe(index)}"
+        Log.write(f"Unit {unit_no}: {message}")
+        if count >= max_warnings:
+            errors.append(message)
+        else:
+            warnings.append(message)
+    return errors, warnings
+
+def check_flatline(regex, data, min_value, max_value, unit_no, bad_indices):
+    errors, warnings = [], []
+    resolved = _column_values(regex, data, bad_indices)
+    if resolved is None:
+        return errors, warnings
+    column_name, values = resolved
+    if len(values) == 0:
+        return errors, warnings
+    samples = max(FLATLINE_MINUTES // time_step_minutes(data), 2)
+    # Start a new run wherever the value changes (NaN never equals itself, so gaps break runs)
+    change = np.ones(len(values), dtype=bool)
+    change[1:] = values[1:] != values[:-1]
+    starts = np.flatnonzero(change)
+    lengths = np.diff(np.append(starts, len(values)))
+    for start, length in zip(starts, lengths):
+        if length >= samples and not np.isnan(values[start]):
+            message = f"{data.iloc[start, 0]} Index {start}: {column_name} flatline at {values[start]} for {length} samples - Possible stuck sensor"
+            print(f"{color.YELLOW}Unit {unit_no}: {message}{color.END}")
+            Log.write(f"Unit {unit_no}: {message}")
+            errors.append(message)
+    return errors, warnings
+
+def check_rate_of_change(regex, data, min_value, max_value, unit_no, bad_indices):
+    resolved = _column_values(regex, data, bad_indices)
+    if resolved is None:
+        return [], []
+    column_name, values = resolved
+    max_step = RATE_FRACTION * (max_value - min_value)
+    steps = np.abs(np.diff(values))
+    with np.errstate(invalid='ignore'):
+        flags = np.flatnonzero(steps > max_step) + 1
+    return _report_flags(flags, data, unit_no, column_name,
+                         lambda index: f"changed by {round(values[index] - values[index - 1], 3)} in one sample, Limit: {max_step}")
+
+def check_spike(regex, data, min_value, max_value, unit_no, bad_indices):
+    resolved = _column_values(regex, data, bad_indices)
+    if resolved is None:
+        return [], []
+    column_name, values = resolved
+    mean, std = _rolling_mean_std(values, SPIKE_WINDOW)
+    std = np.maximum(std, SPIKE_MIN_STD * (max_value - min_value))
+    deviation = np.abs(values - mean)
+    # A spike returns towards the rolling mean on the next sample; a lasting step change is not a spike
+    next_deviation = np.full(len(values), np.inf)
+    next_deviation[:-1] = np.abs(values[1:] - mean[:-1])
+    with np.errstate(invalid='ignore'):
+        flags = np.flatnonzero((deviation / std > SPIKE_Z) & (next_deviation < deviation / 2))
+    return _report_flags(flags, data, unit_no, column_name,
+                         lambda index: f"spike, Value: {values[index]}, Rolling mean: {round(mean[index], 3)}")
+
+def check_temperature(regex, data, min_value, max_value, unit_no, bad_indices):
+    errors, warnings = check_limits(regex, data, min_value, max_value, unit_no, bad_indices)
+    if f"Column not found: {regex}" in errors:
+        return errors, warnings
+    for check in [check_flatline, check_rate_of_change, check_spike]:
+        check_errors, check_warnings = check(regex, data, min_value, max_value, unit_no, bad_indices)
+        errors += check_errors
+        warnings += check_warnings
+    return errors, warnings
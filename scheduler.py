@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import traceback
+from datetime import datetime, timedelta
+from unit import Unit
+from log import Log
+from color import color
+import daily
+import gapfill
+import qualitycheck
+
+STATUS_PATH = './Logs/scheduler_status.json'
+POLL_SECONDS = 30 # Longest sleep between schedule checks
+# Job -> cron expression: minute hour day-of-month month day-of-week (0 or 7 is Sunday)
+SCHEDULE = {
+    'daily': '0 1 * * *',
+    'gapfill': '0 2 * * *',
+    'monthly': '0 3 1 * *',
+    'quality': '0 5 * * 0'
+}
+
+def run_daily(metrics: bool):
+    daily.main(metrics=metrics)
+
+def run_gapfill(metrics: bool):
+    gapfill.main(metrics=metrics)
+
+def run_monthly(metrics: bool):
+    # Imported on first use since it builds the Drive client, then stays loaded
+    import monthly
+    monthly.main(metrics=metrics)
+
+def run_quality(metrics: bool):
+    qualitycheck.main(metrics=metrics)
+
+JOBS = {
+    'daily': run_daily,
+    'gapfill': run_gapfill,
+    'monthly': run_monthly,
+    'quality': run_quality
+}
+
+class CronSchedule:
+    '''
+    Five-field cron expression supporting *, numbers, lists, ranges and steps (e.g. "*/15 0-6 1,15 * 1-5")
+    '''
+    FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(part, low, high) for part, (low, high) in zip(parts, self.FIELDS))
+        self.weekdays = {weekday % 7 for weekday in self.weekdays}
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> set:
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (int(value) for value in part.split('-'))
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Invalid cron field: {field}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, when: datetime) -> bool:
+        weekday = (when.weekday() + 1) % 7
+        day, weekday = when.day in self.days, weekday in self.weekdays
+        # Like cron, a restricted day of month and day of week match if either one does
+        if not self.any_day and not self.any_weekday:
+            return day or weekday
+        return day and weekday
+
+    def matches(self, when: datetime) -> bool:
+        return when.month in self.months and self._day_matches(when) and when.hour in self.hours and when.minute in self.minutes
+
+    def next_run(self, after: datetime) -> datetime:
+        '''
+        First matching minute after the given time
+        '''
+        when = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = when + timedelta(days=366 * 5)
+        while when < limit:
+            if when.month not in self.months or not self._day_matches(when):
+                when = when.replace(hour=0, minute=0) + timedelta(days=1)
+            elif when.hour not in self.hours:
+                when = when.replace(minute=0) + timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when += timedelta(minutes=1)
+            else:
+                return when
+        raise ValueError(f"Cron expression never matches: {self.expression}")
+
+class Scheduler:
+    '''
+    Long-running process that runs the daily, monthly and quality jobs on their schedules.
+    Modules, the Drive client and the dashbox connection pool stay loaded between runs, dates are
+    recomputed before every run, and job status and timings are written to a status file.
+    '''
+    def __init__(self, schedule: dict = SCHEDULE, status_path: str = STATUS_PATH, metrics: bool = False):
+        self.schedules = {name: CronSchedule(expression) for name, expression in schedule.items()}
+        for name in self.schedules:
+            if name not in JOBS:
+                raise ValueError(f"Unknown job: {name}, expected one of {list(JOBS)}")
+        self.status_path = status_path
+        self.metrics = metrics
+        now = datetime.now()
+        self.next_runs = {name: cron.next_run(now) for name, cron in self.schedules.items()}
+        self.status = {
+            "pid": os.getpid(),
+            "started": now.isoformat(timespec='seconds'),
+            "jobs": {name: {"schedule": cron.expression, "runs": 0, "running": False} for name, cron in self.schedules.items()}
+        }
+
+    def write_status(self):
+        if self.status_path is None:
+            return
+        for name, next_run in self.next_runs.items():
+            self.status["jobs"][name]["next_run"] = next_run.isoformat(timespec='seconds')
+        self.status["updated"] = datetime.now().isoformat(timespec='seconds')
+        os.makedirs(os.path.dirname(self.status_path) or '.', exist_ok=True)
+        tmp_path = f'{self.status_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.status, f, indent=4)
+        os.replace(tmp_path, self.status_path)
+
+    def run_job(self, name: str) -> bool:
+        '''
+        Run one job now, recording its status
+
+        return: bool: True if the job finished without an exception
+        '''
+        Unit.refresh_dates()
+        job = self.status["jobs"].setdefault(name, {"runs": 0})
+        job.update({"running": True, "last_started": datetime.now().isoformat(timespec='seconds')})
+        self.write_status()
+        print(f"Scheduler: running {name}")
+        start = time.perf_counter()
+        ok, error = True, None
+        try:
+            JOBS[name](self.metrics)
+        except Exception as e:
+            ok, error = False, f"{type(e).__name__}: {str(e)}"
+            traceback.print_exc()
+            Log.write(f"Scheduler: {name} failed: {error}")
+            print(f"{color.RED}Scheduler: {name} failed: {error}{color.END}")
+        job.update({
+            "running": False,
+            "runs": job["runs"] + 1,
+            "last_finished": datetime.now().isoformat(timespec='seconds'),
+            "last_seconds": round(time.perf_counter() - start, 2),
+            "last_ok": ok,
+            "last_error": error
+        })
+        self.write_status()
+        return ok
+
+    def run(self):
+        '''
+        Run jobs as they come due, one at a time. A job that came due while another was running starts
+        once it finishes; missed runs are not repeated.
+        '''
+        self.write_status()
+        while True:
+            for name in sorted(self.next_runs, key=self.next_runs.get):
+                if self.next_runs[name] <= datetime.now():
+                    self.run_job(name)
+                    self.next_runs[name] = self.schedules[name].next_run(datetime.now())
+                    self.write_status()
+            wait = (min(self.next_runs.values()) - datetime.now()).total_seconds()
+            time.sleep(min(max(wait, 1), POLL_SECONDS))
+
+if __name__ == "__main__":
+    # python scheduler.py [--metrics]       run as a daemon
+    # python scheduler.py --run daily       run one job now and exit
+    # python scheduler.py --status          print the status file of the running daemon
+    if '--status' in sys.argv:
+        with open(STATUS_PATH, 'r') as f:
+            print(f.read())
+    elif '--run' in sys.argv:
+        # One-off runs do not overwrite the daemon's status file
+        scheduler = Scheduler(status_path=None, metrics='--metrics' in sys.argv)
+        sys.exit(0 if scheduler.run_job(sys.argv[sys.argv.index('--run') + 1]) else 1)
+    else:
+        Scheduler(metrics='--metrics' in sys.argv).run()
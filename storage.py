@@ -0,0 +1,85 @@
+import os
+import gzip
+
+# File extension for each supported CSV compression. zstd needs the optional zstandard package.
+EXTENSIONS = {
+    None: '.csv',
+    'gzip': '.csv.gz',
+    'zstd': '.csv.zst'
+}
+MIMETYPES = {
+    '.csv': 'text/csv',
+    '.csv.gz': 'application/gzip',
+    '.csv.zst': 'application/zstd'
+}
+
+def check_compression(compression):
+    '''
+    Raise ValueError if the compression is unknown or its library is not installed
+
+    param: compression: str: None, 'gzip' or 'zstd'
+    '''
+    if compression not in EXTENSIONS:
+        raise ValueError(f"Unknown compression: {compression}, expected one of {list(EXTENSIONS)}")
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+
+def csv_name(stem: str, compression=None) -> str:
+    '''
+    File name for a CSV with the given compression, e.g. Unit_77_2025-01-01.csv.gz
+    '''
+    return stem + EXTENSIONS[compression]
+
+def csv_extension(filename: str) -> str:
+    '''
+    CSV extension of a file name, longest match first, None if it is not a CSV
+    '''
+    for extension in sorted(MIMETYPES, key=len, reverse=True):
+        if filename.endswith(extension):
+            return extension
+    return None
+
+def is_csv(filename: str) -> bool:
+    return csv_extension(filename) is not None
+
+def csv_stem(filename: str) -> str:
+    '''
+    File name without its CSV extension
+    '''
+    extension = csv_extension(filename)
+    return filename[:-len(extension)] if extension else filename
+
+def mimetype(filename: str) -> str:
+    return MIMETYPES.get(csv_extension(filename), 'application/octet-stream')
+
+def compress_bytes(body: bytes, compression=None) -> bytes:
+    '''
+    Compress raw bytes to match a CSV extension
+    '''
+    if compression == 'gzip':
+        return gzip.compress(body)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(body)
+    return body
+
+def compress_file(source: str, destination: str, compression=None, chunk_size: int = 1 << 20):
+    '''
+    Copy a file, compressed to match a CSV extension, in chunks so large files are never read into memory at once
+    '''
+    tmp_path = f'{destination}.tmp'
+    with open(source, 'rb') as src:
+        if compression == 'gzip':
+            dst = gzip.open(tmp_path, 'wb')
+        elif compression == 'zstd':
+            import zstandard
+            dst = zstandard.ZstdCompressor().stream_writer(open(tmp_path, 'wb'))
+        else:
+            dst = open(tmp_path, 'wb')
+        with dst:
+            while chunk := src.read(chunk_size):
+                dst.write(chunk)
+    os.replace(tmp_path, destination)
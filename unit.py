@@ -2,14 +2,17 @@ import pandas as pd
 import re
 import os
 from datetime import datetime
-from rules import check_missing_rows, check_total_energy
-from channels import channels
+from rules import check_missing_rows, check_total_energy, ENERGY_REGEXES
+from channels import channels, check_channels
 from log import Log
 from color import color
-from urllib.request import urlopen
 from bs4 import BeautifulSoup
 from alert import send_email
 from dateutil.relativedelta import relativedelta
+from io import BytesIO
+from metrics import Metrics
+from storage import csv_name, is_csv, compress_bytes
+import dashbox
 
 def is_float(value):
     try:
@@ -18,6 +21,35 @@ def is_float(value):
     except (ValueError, TypeError):
         return False
 
+def status_url(address: str) -> str:
+    '''
+    Dashbox page with the status light and SD card space
+
+    param: address: str: ip:port of the dashbox
+    '''
+    return f'http://{address}/index.php/powerdisplay/getmainwatts'
+
+def parse_status(html: str):
+    '''
+    Status light of a dashbox getmainwatts page
+
+    param: html: str: page html
+    return: str: image src of the status light (green when OK), None if the page has none
+    '''
+    status_logo = BeautifulSoup(html, 'html.parser').find("img")
+    return status_logo['src'] if status_logo else None
+
+def parse_space(html: str) -> str:
+    '''
+    Space left on the SD card from a dashbox getmainwatts page
+
+    param: html: str: page html
+    return: str: GB left as shown on the page
+    '''
+    outer_span = BeautifulSoup(html, 'html.parser').find_all("span", title='\\"Total')[-1]
+    inner_span = outer_span.find("span")
+    return inner_span.text.split('<')[0]
+
 class Unit:
     block_1 = [2804, 2806, 2808, 2810, 2812, 2814, 2816, 2818]
     block_3 = [77, 78, 79, 80, 81, 82, 83, 84, 85, 86]
@@ -25,10 +57,22 @@ class Unit:
     units = block_1 + block_3
     datatype = ""
 
+    cache = None # RawCache used by _download when set
+    compression = None # Compression for saved csv files: None, 'gzip' or 'zstd'
+
     yesterday = (datetime.now() - pd.Timedelta(days=1)).strftime('%Y-%m-%d')
     last_month = (datetime.today() - relativedelta(months=1)).strftime('%Y-%m')
 
-    def __init__(self, unit_no: int = 0, block: int = 0, ip_address: str = "", port: str = "", serial: str = "", channels: dict = None, data: pd.DataFrame = None):
+    @staticmethod
+    def refresh_dates():
+        '''
+        Recompute yesterday and last month (and Log's dates), for processes that run across midnight
+        '''
+        Unit.yesterday = (datetime.now() - pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+        Unit.last_month = (datetime.today() - relativedelta(months=1)).strftime('%Y-%m')
+        Log.refresh_dates()
+
+    def __init__(self, unit_no: int = 0, block: int = 0, ip_address: str = "", port: str = "", serial: str = "", channels: dict = None, data: pd.DataFrame = None, plan: tuple = None):
         self.unit_no = unit_no
         self.block = block # Deprecated
         self.data = data
@@ -36,8 +80,11 @@ class Unit:
         self.port = port
         self.serial = serial
         self.channels = channels
+        # Enabled channels in config order, shared between units built by the UnitRegistry
+        self.plan = plan if plan is not None else tuple(channel for channel, enabled in (channels or {}).items() if enabled == True)
         self.warnings = []
         self.errors = []
+        self.saved_path = None # File written by the last check_quality(save_files=True)
                 
     def __str__(self):
         return f"Unit {self.unit_no}"
@@ -102,22 +149,102 @@ class Unit:
             self.errors.append(f"Unit {self.unit_no}: Error sorting data by timestamp: {str(e)}")
             return df
 
+    def _keep_column(self, column:str) -> bool:
+        '''
+        Projection filter: keep date columns, enabled channels and the energy balance columns
+
+        param: column: str: column name from the csv header
+        return: bool: True if the column is needed for checking
+        '''
+        if column.startswith('Date') or column == 'Timestamp':
+            return True
+        regexes = [channels[channel].regex for channel in self.plan] + ENERGY_REGEXES
+        return any(re.search(regex, column) for regex in regexes)
+
+    def project_data(self, df:pd.DataFrame):
+        '''
+        Drop columns that are not needed for checking and downcast the kept value columns to float32
+
+        param: df: pd.DataFrame: data to project
+        return: pd.DataFrame: projected data
+        '''
+        if df is None or df.empty:
+            return df
+        df = df[[column for column in df.columns if self._keep_column(column)]]
+        value_columns = [column for column in df.columns if not (column.startswith('Date') or column == 'Timestamp')]
+        df = df.copy()
+        df[value_columns] = df[value_columns].apply(pd.to_numeric, errors='coerce').astype('float32')
+        return df
+
+    def _archive_raw(self, body:bytes, url:str):
+        '''
+        Save the raw response body so the columns dropped by projection are not lost
+
+        param: body: bytes: raw csv body
+        param: url: str: url the body was downloaded from
+        '''
+        path = f'./Raw_Data/UNIT {self.unit_no}'
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(f'{path}/' + csv_name(f'Unit_{self.unit_no}_{url.split("/")[-1]}', Unit.compression), 'wb') as f:
+            f.write(compress_bytes(body, Unit.compression))
+
     def _natural_sort_key(self, s):
         return [int(text) if text.isdigit() else text.lower() for text in re.split('(\\d+)', s)]
     
-    def _download(self, url:str):
+    def _fetch(self, url:str) -> bytes:
+        '''
+        Fetch the raw response body from the given url
+
+        param: url: str: url to fetch
+        return: bytes: response body
+        '''
+        with Metrics.stage("download", self.unit_no):
+            body = dashbox.fetch(url)
+        Metrics.add("bytes_downloaded", len(body), self.unit_no)
+        return body
+
+    def _download(self, url:str, project:bool = False, archive_raw:bool = False, refresh:bool = False):
         '''
         Download data from the given url
 
         param: url: str: url to download data from
+        param: project: bool: keep only the columns needed for checking, as float32
+        param: archive_raw: bool: save the full raw export to Raw_Data/ when projecting
+        param: refresh: bool: ignore any cached copy and download again
         '''
-        Log.write(f"Downloading Unit {self.unit_no}: {self.ip_address}:{self.port}")
-        print(f"Downloading Unit {self.unit_no}: {self.ip_address}:{self.port}")
+        # Export urls end in .../{endpoint}/{serial}/{date}
+        endpoint, serial, date = url.rstrip('/').split('/')[-3:]
+        body = None
+        if Unit.cache is not None and not refresh:
+            body = Unit.cache.get(serial, endpoint, date)
+        if body is not None:
+            Log.write(f"Unit {self.unit_no}: Using cached {endpoint} for {date}")
+            print(f"Unit {self.unit_no}: Using cached {endpoint} for {date}")
+            Metrics.add("cache_hits", 1, self.unit_no)
+        else:
+            Log.write(f"Downloading Unit {self.unit_no}: {self.ip_address}:{self.port}")
+            print(f"Downloading Unit {self.unit_no}: {self.ip_address}:{self.port}")
         try:
-            response = pd.read_csv(url, header=0, on_bad_lines='skip')
-            if response.empty:
-                raise ValueError("Downloaded data is empty")
-            self.data = self.sort_data(response)
+            if body is None:
+                body = self._fetch(url)
+                fetched = True
+            else:
+                fetched = False
+            if project and archive_raw:
+                self._archive_raw(body, url)
+            with Metrics.stage("parse", self.unit_no):
+                if project:
+                    response = self.project_data(pd.read_csv(BytesIO(body), header=0, on_bad_lines='skip', usecols=self._keep_column))
+                else:
+                    response = pd.read_csv(BytesIO(body), header=0, on_bad_lines='skip')
+                if response.empty:
+                    raise ValueError("Downloaded data is empty")
+                self.data = self.sort_data(response)
+            Metrics.add("rows_parsed", len(self.data), self.unit_no)
+            # Only bodies that parsed are cached, so a failed download is retried next time
+            if fetched and Unit.cache is not None:
+                Unit.cache.put(serial, endpoint, date, body)
             print(f"Downloaded data for Unit {self.unit_no}")
         except (pd.errors.EmptyDataError, ValueError) as e:
             Log.write(f"Unit {self.unit_no}: Empty data from {url}\n\n")
@@ -143,62 +270,82 @@ class Unit:
             actual_columns = min(num_columns, len(self.data.columns))
             self.data = self.data.iloc[:, :actual_columns]
 
-    def load_data(self, path:str):
+    def _read_csv(self, path:str, project:bool = False):
+        if project:
+            return self.project_data(pd.read_csv(path, usecols=self._keep_column))
+        return pd.read_csv(path)
+
+    def load_data(self, path:str, project:bool = False):
         '''
         Load data from a csv file or a directory of csv files
         Used for testing purposes
 
         param: path: str: path to the csv file or directory
+        param: project: bool: keep only the columns needed for checking, as float32
         '''
         if os.path.isdir(path):
             for dir_name in os.listdir(path):
                 if f'{self.unit_no}' in dir_name:
                     dir_path = os.path.join(path, dir_name)
-                    all_files = [os.path.join(dir_path, f) for f in os.listdir(dir_path) if (os.path.isfile(os.path.join(dir_path, f)) and f.endswith('.csv'))]
+                    all_files = [os.path.join(dir_path, f) for f in os.listdir(dir_path) if (os.path.isfile(os.path.join(dir_path, f)) and is_csv(f))]
                     all_files.sort(key=self._natural_sort_key)
-                    all_files = [self.sort_data(pd.read_csv(f)) for f in all_files]
+                    all_files = [self.sort_data(self._read_csv(f, project)) for f in all_files]
                     if len(all_files) > 0:
                         self.data = pd.concat((f for f in all_files), ignore_index=True)
         else:
-            self.data = self.sort_data(pd.read_csv(path))
+            self.data = self.sort_data(self._read_csv(path, project))
         if self.data is None or self.data.empty:
             return False
         self._crop_data_columns()
         return True
 
-    def download_minute_data(self, date=yesterday):
+    def download_minute_data(self, date=None, project:bool = False, archive_raw:bool = False, refresh:bool = False):
         '''
         Download data for the last day (minute data)
+
+        param: date: str: date in YYYY-MM-DD format, defaults to yesterday
+        param: project: bool: keep only the columns needed for checking, as float32
+        param: archive_raw: bool: save the full raw export to Raw_Data/ when projecting
+        param: refresh: bool: ignore any cached copy and download again
         '''
-        # date in YYYY-MM-DD format
-        url = f'http://{self.ip_address}:{self.port}/index.php/pages/export/exportDaily/{self.serial}/{date}'
         self.datatype = "Minute"
-        self._download(url)
+        self._download(self.minute_url(date), project, archive_raw, refresh)
+
+    def minute_url(self, date=None) -> str:
+        '''
+        Dashbox export of one day of minute data
+
+        param: date: str: date in YYYY-MM-DD format, defaults to yesterday
+        '''
+        date = date or Unit.yesterday
+        return f'http://{self.ip_address}:{self.port}/index.php/pages/export/exportDaily/{self.serial}/{date}'
 
-    def download_hour_data(self, date=last_month):
+    def download_hour_data(self, date=None):
         '''
         Download data for the specified month (hourly data)
         
-        param: date: str: date in YYYY-MM format
+        param: date: str: date in YYYY-MM format, defaults to last month
         '''
+        date = date or Unit.last_month
         url = f'http://{self.ip_address}:{self.port}/index.php/pages/export/exportMonthly/{self.serial}/{date}'
         self.datatype = "Hour"
         self._download(url)
 
+    def status_url(self) -> str:
+        '''
+        Dashbox page with the status light and SD card space
+        '''
+        return status_url(f'{self.ip_address}:{self.port}')
+
     def check_space(self):
         '''
         Check the space available on the sd card
         '''
-        url = f'http://{self.ip_address}:{self.port}/index.php/powerdisplay/getmainwatts'
         try:
-            page = urlopen(url)
-            html_bytes = page.read()
-            html = html_bytes.decode("utf-8")
-            soup = BeautifulSoup(html, 'html.parser')
-            outer_span = soup.find_all("span", title='\\"Total')[-1]
-            
-            inner_span = outer_span.find("span")
-            space = inner_span.text.split('<')[0]
+            with Metrics.stage("check_space", self.unit_no):
+                html_bytes = dashbox.fetch(self.status_url())
+            Metrics.add("bytes_downloaded", len(html_bytes), self.unit_no)
+            space = parse_space(html_bytes.decode("utf-8"))
             if is_float(space) and float(space) > 1 and float(space) < 40:
                 Log.write(f"Unit {self.unit_no}: {space} GB left on the SD card")
                 print(f"Unit {self.unit_no}: {space} GB left on the SD card")
@@ -217,18 +364,13 @@ class Unit:
         '''
         Check the status of the dashbox
         '''
-        url = f'http://{self.ip_address}:{self.port}/index.php/powerdisplay/getmainwatts'
         body = f"Unit {self.unit_no}: Dashbox Status Error\n\n{self.ip_address}:{self.port}"
         try:
-            page = urlopen(url)
-            html_bytes = page.read()
-            html = html_bytes.decode("utf-8")
-            soup = BeautifulSoup(html, 'html.parser')
-            status_logo = soup.find("img")
-            # print(status_logo)
-            if status_logo:
-                img_src = status_logo['src']
-                # print(img_src)
+            with Metrics.stage("check_status", self.unit_no):
+                html_bytes = dashbox.fetch(self.status_url())
+            Metrics.add("bytes_downloaded", len(html_bytes), self.unit_no)
+            img_src = parse_status(html_bytes.decode("utf-8"))
+            if img_src:
                 if 'green' in img_src:
                     Log.write(f"Unit {self.unit_no}: Dashbox Status OK")
                     print(f"{color.GREEN}Unit {self.unit_no}: Dashbox Status OK{color.END}")
@@ -244,7 +386,7 @@ class Unit:
             print(f"{color.RED}Something went wrong with status check{color.END}")
         # print(status_logo)
 
-    def check_quality(self, save_files:bool, date=yesterday):
+    def check_quality(self, save_files:bool, date=None):
         '''
         Check the quality of the data using the rules provided
 
@@ -253,31 +395,26 @@ class Unit:
         '''
         if self.data is None:
             return self.errors, self.warnings
+        date = date or Unit.yesterday
         
         Log.write(f"Checking Unit {self.unit_no}: {self.ip_address}:{self.port}")
         print(f"Checking Unit {self.unit_no}: {self.ip_address}:{self.port}")
-        self.data, missing_row_errors, missing_row_warnings, bad_indices = check_missing_rows(self.data, self.unit_no)
+        with Metrics.stage("check_missing_rows", self.unit_no):
+            self.data, missing_row_errors, missing_row_warnings, bad_indices = check_missing_rows(self.data, self.unit_no)
         self.errors += missing_row_errors
         self.warnings += missing_row_warnings
+        Metrics.add("rows_checked", len(self.data), self.unit_no)
 
-        if (self.datatype == "Hour"):
-            if save_files:
-                last_month = (datetime.today() - relativedelta(months=1)).strftime('%Y-%m')
-                if not os.path.exists(f'{self.datatype}_Data/UNIT {self.unit_no}'):
-                    os.makedirs(f'./{self.datatype}_Data/UNIT {self.unit_no}')
-                self.data.to_csv(f'./{self.datatype}_Data/UNIT {self.unit_no}/Unit_{self.unit_no}_{last_month}.csv', index=False)
-            return
-
-        energy_errors, energy_warnings = check_total_energy(self.data, self.unit_no)
+        with Metrics.stage("check_total_energy", self.unit_no):
+            energy_errors, energy_warnings = check_total_energy(self.data, self.unit_no)
         self.errors += energy_errors
         self.warnings += energy_warnings
 
-        for channel in self.channels:
-            if self.channels[channel] == True:
-                # use the channel check quality function
-                channel_errors, channel_warnings = channels[channel].check_channel(self.data, self.unit_no, bad_indices)
-                self.errors += channel_errors
-                self.warnings += channel_warnings
+        with Metrics.stage("check_channels", self.unit_no):
+            channel_errors, channel_warnings = check_channels(self.data, self.unit_no, self.plan, bad_indices)
+            self.errors += channel_errors
+            self.warnings += channel_warnings
+        Metrics.add("issues_emitted", len(self.errors) + len(self.warnings), self.unit_no)
         if len(self.errors) == 0 and len(self.warnings) == 0:
             print(f"{color.GREEN}Unit {self.unit_no}: Passed all systems checks{color.END}")
             Log.write(f"Unit {self.unit_no}: Passed all systems checks")
@@ -285,6 +422,11 @@ class Unit:
         if save_files:
             if not os.path.exists(f'./{self.datatype}_Data/UNIT {self.unit_no}'):
                 os.makedirs(f'./{self.datatype}_Data/UNIT {self.unit_no}')
-            self.data.to_csv(f'./{self.datatype}_Data/UNIT {self.unit_no}/Unit_{self.unit_no}_{str(date)}.csv', index=False)
+            if self.datatype == "Hour":
+                # Hourly data covers a month, name the file after the month of the data
+                date = pd.to_datetime(self.data.iloc[0, 0]).strftime('%Y-%m')
+            self.saved_path = f'./{self.datatype}_Data/UNIT {self.unit_no}/' + csv_name(f'Unit_{self.unit_no}_{str(date)}', Unit.compression)
+            with Metrics.stage("save", self.unit_no):
+                self.data.to_csv(self.saved_path, index=False)
         Log.write("\n")
         return self.errors, self.warnings
@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import threading
+import multiprocessing
+from unit import Unit
+from log import Log
+from color import color
+from metrics import Metrics
+from registry import UnitRegistry
+from qualitystore import QualityStore
+from rollup import summarize_minutes
+from monthfile import append_day
+from breaker import CircuitBreaker
+
+QUEUE_PATH = './workqueue.sqlite' # Workers on other hosts need this file on a network filesystem with working POSIX locks (e.g. NFSv4)
+LEASE_SECONDS = 600 # A claimed task is handed to another worker if its lease is not renewed in time
+HEARTBEAT_SECONDS = 60 # How often a worker renews the lease of the task it is running
+MAX_ATTEMPTS = 3 # Attempts before a task is marked failed
+POLL_SECONDS = 5 # Idle workers check for new tasks this often
+
+def run_download(unit: Unit, date: str) -> dict:
+    '''
+    Download, probe, check and save one unit's minute data for a day, like one unit of daily.download_minute.
+    A unit the circuit breaker has open is skipped the same way, and the breaker's reports go into the result.
+    '''
+    breaker = CircuitBreaker()
+    if not breaker.allow(unit.unit_no, unit.status_url()):
+        Log.record_failed_downloads(unit.unit_no, date, unit.minute_url(date))
+        return {"rows": 0, "errors": [], "warnings": [], "reports": []}
+    unit.download_minute_data(date)
+    breaker.record(unit.unit_no, unit.data is not None)
+    reports = breaker.reports()
+    if breaker.is_open(unit.unit_no):
+        # A failed retry of an offline unit is not reported again, and its status and space checks would time out too
+        return {"rows": 0, "errors": [], "warnings": [], "reports": reports}
+    unit.check_status()
+    unit.check_space()
+    unit.check_quality(True, date)
+    if unit.data is not None:
+        QualityStore().save_rollups(unit.unit_no, summarize_minutes(unit, unit.data))
+        append_day(unit.unit_no, unit.saved_path)
+    return {"rows": 0 if unit.data is None else len(unit.data), "errors": unit.errors, "warnings": unit.warnings, "reports": reports}
+
+def run_check(unit: Unit, date: str) -> dict:
+    '''
+    Recheck a stored day of minute data without downloading it again
+    '''
+    unit_dir = f'./Minute_Data/UNIT {unit.unit_no}'
+    files = [file for file in os.listdir(unit_dir) if file.startswith(f'Unit_{unit.unit_no}_{date}.')] if os.path.isdir(unit_dir) else []
+    if not files or not unit.load_data(os.path.join(unit_dir, files[0])):
+        raise FileNotFoundError(f"No stored minute data for unit {unit.unit_no} on {date}")
+    unit.datatype = "Minute"
+    unit.check_quality(False, date)
+    return {"rows": len(unit.data), "errors": unit.errors, "warnings": unit.warnings}
+
+def run_report(unit: Unit, date: str) -> dict:
+    '''
+    Update one unit's quality report from its stored data
+    '''
+    # Imported here so download workers do not load openpyxl
+    from qualitycheck import QualityChecker
+    checker = QualityChecker()
+    checker.update_quality_report(unit.unit_no, checker.check_data_quality(unit.unit_no))
+    return {"errors": [], "warnings": []}
+
+HANDLERS = {
+    'download': run_download,
+    'check': run_check,
+    'report': run_report
+}
+
+class WorkQueue:
+    '''
+    Per-unit tasks in SQLite, claimed by worker processes with a lease.
+    A worker renews its lease while it runs a task; a task whose lease expires (the worker died or hung) is
+    claimed again by another worker, up to MAX_ATTEMPTS. Results are stored with the task.
+    '''
+    def __init__(self, path: str = QUEUE_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        # WAL needs shared memory on one host, the rollback journal only needs file locks so the queue can be shared
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                unit_no INTEGER NOT NULL,
+                date TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_expires REAL,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL,
+                result TEXT,
+                error TEXT,
+                UNIQUE (kind, unit_no, date)
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_expires)')
+
+    def close(self):
+        self.conn.close()
+
+    def enqueue(self, kind: str, unit_numbers: list, date: str) -> int:
+        '''
+        Queue one task per unit, tasks that already exist for the same (kind, unit, date) are kept
+
+        return: int: number of tasks added
+        '''
+        if kind not in HANDLERS:
+            raise ValueError(f"Unknown task kind: {kind}, expected one of {list(HANDLERS)}")
+        now = time.time()
+        cursor = self.conn.executemany('INSERT OR IGNORE INTO tasks (kind, unit_no, date, created) VALUES (?, ?, ?, ?)',
+                                       [(kind, int(unit_no), date, now) for unit_no in unit_numbers])
+        return cursor.rowcount
+
+    def claim(self, worker: str):
+        '''
+        Lease the oldest queued task, or a leased task whose lease has expired
+
+        return: sqlite3.Row: the claimed task, None if there is nothing to do
+        '''
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Tasks abandoned by workers that have used up their attempts are failed instead of retried
+            self.conn.execute('''UPDATE tasks SET state = 'failed', error = 'lease expired', finished = ?
+                                 WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?''', (now, now, MAX_ATTEMPTS))
+            task = self.conn.execute('''SELECT * FROM tasks WHERE state = 'queued' OR (state = 'leased' AND lease_expires < ?)
+                                        ORDER BY id LIMIT 1''', (now,)).fetchone()
+            if task is not None:
+                self.conn.execute('''UPDATE tasks SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, started = ?
+                                     WHERE id = ?''', (worker, now + LEASE_SECONDS, now, task['id']))
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        return task
+
+    def heartbeat(self, task_id: int, worker: str) -> bool:
+        '''
+        Renew a lease
+
+        return: bool: False if the task is no longer leased to this worker
+        '''
+        cursor = self.conn.execute("UPDATE tasks SET lease_expires = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                                   (time.time() + LEASE_SECONDS, task_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, task_id: int, worker: str, result: dict):
+        self.conn.execute("UPDATE tasks SET state = 'done', result = ?, error = NULL, finished = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                          (json.dumps(result), time.time(), task_id, worker))
+
+    def fail(self, task_id: int, worker: str, error: str):
+        '''
+        Record a failed attempt; the task is queued again until it has used MAX_ATTEMPTS
+        '''
+        self.conn.execute('''UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+                             error = ?, finished = ? WHERE id = ? AND worker = ? AND state = 'leased\'''',
+                          (MAX_ATTEMPTS, error, time.time(), task_id, worker))
+
+    def counts(self, date: str = None) -> dict:
+        '''
+        return: dict[str, dict[str, int]]: kind -> state -> number of tasks
+        '''
+        query = 'SELECT kind, state, COUNT(*) FROM tasks' + (' WHERE date = ?' if date else '') + ' GROUP BY kind, state'
+        counts = {}
+        for kind, state, count in self.conn.execute(query, (date,) if date else ()):
+            counts.setdefault(kind, {})[state] = count
+        return counts
+
+    def results(self, kind: str, date: str) -> list:
+        '''
+        return: list[sqlite3.Row]: tasks of one kind and date, in unit order
+        '''
+        return self.conn.execute('SELECT * FROM tasks WHERE kind = ? AND date = ? ORDER BY unit_no', (kind, date)).fetchall()
+
+def _heartbeat(path: str, task_id: int, worker: str, stop: threading.Event):
+    # SQLite connections are per thread, the heartbeat uses its own
+    queue = WorkQueue(path)
+    try:
+        while not stop.wait(HEARTBEAT_SECONDS):
+            if not queue.heartbeat(task_id, worker):
+                print(f"{color.YELLOW}{worker}: lost the lease of task {task_id}{color.END}")
+                return
+    finally:
+        queue.close()
+
+def work(path: str = QUEUE_PATH, worker: str = None, drain: bool = False, config_path: str = 'config/'):
+    '''
+    Claim and run tasks until stopped
+
+    param: path: str: queue database
+    param: worker: str: worker name, defaults to host:pid
+    param: drain: bool: return when there is nothing left to claim instead of waiting for new tasks
+    return: int: number of tasks run
+    '''
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    queue = WorkQueue(path)
+    registry = UnitRegistry.get(config_path)
+    ran = 0
+    while True:
+        task = queue.claim(worker)
+        if task is None:
+            if drain:
+                queue.close()
+                return ran
+            time.sleep(POLL_SECONDS)
+            continue
+        Unit.refresh_dates()
+        print(f"{worker}: {task['kind']} unit {task['unit_no']} {task['date']} (attempt {task['attempts'] + 1})")
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(path, task['id'], worker, stop), daemon=True)
+        heartbeat.start()
+        try:
+            with Metrics.stage(task['kind'], task['unit_no']):
+                result = HANDLERS[task['kind']](registry.unit(task['unit_no']), task['date'])
+            queue.complete(task['id'], worker, result)
+        except Exception as e:
+            error = f"{type(e).__name__}: {str(e)}"
+            Log.write(f"Unit {task['unit_no']}: {task['kind']} task failed on {worker}: {error}")
+            print(f"{color.RED}{worker}: {task['kind']} unit {task['unit_no']} failed: {error}{color.END}")
+            queue.fail(task['id'], worker, error)
+        finally:
+            stop.set()
+            heartbeat.join()
+        ran += 1
+
+def run_workers(processes: int, path: str = QUEUE_PATH, drain: bool = False):
+    '''
+    Run several worker processes on this host
+    '''
+    workers = [multiprocessing.Process(target=work, args=(path, None, drain)) for _ in range(processes)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+def email_results(date: str, path: str = QUEUE_PATH):
+    '''
+    Send the daily summary email from the stored results of a day's download tasks
+    '''
+    # Imported here since daily builds the email from Unit objects
+    from daily import compile_email_body
+    from alert import send_email
+    registry = UnitRegistry.get()
+    units = []
+    # Units that went offline or came back, reported once like in daily.py
+    fleet_issues = []
+    for task in WorkQueue(path).results('download', date):
+        unit = registry.unit(task['unit_no'])
+        if task['state'] == 'done':
+            result = json.loads(task['result'])
+            unit.errors, unit.warnings = result['errors'], result['warnings']
+            fleet_issues += result.get('reports', [])
+        else:
+            unit.errors = [f"Unit {unit.unit_no}: download task {task['state']}: {task['error']}"]
+        units.append(unit)
+    if any(unit.errors for unit in units) or fleet_issues:
+        send_email(subject=f"Maple West System Error(s) Detected", body=compile_email_body(units, fleet_issues), attachment=Log.get_path(date))
+    else:
+        send_email(subject=f"Maple West Systems OK", body=f"{date}\nSystems check passed for all units", attachment=Log.get_path(date))
+
+if __name__ == "__main__":
+    # python workqueue.py enqueue download|check|report [--date YYYY-MM-DD] [--units 77,78]
+    # python workqueue.py worker [--processes N] [--drain]
+    # python workqueue.py status [--date YYYY-MM-DD]
+    # python workqueue.py email [--date YYYY-MM-DD]
+    date = sys.argv[sys.argv.index('--date') + 1] if '--date' in sys.argv else Unit.yesterday
+    path = sys.argv[sys.argv.index('--queue') + 1] if '--queue' in sys.argv else QUEUE_PATH
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    if command == 'enqueue':
+        units = [int(unit_no) for unit_no in sys.argv[sys.argv.index('--units') + 1].split(',')] if '--units' in sys.argv else UnitRegistry.get().unit_numbers()
+        print(f"Queued {WorkQueue(path).enqueue(sys.argv[2], units, date)} {sys.argv[2]} tasks for {date}")
+    elif command == 'worker':
+        run_workers(int(sys.argv[sys.argv.index('--processes') + 1]) if '--processes' in sys.argv else 1, path, drain='--drain' in sys.argv)
+    elif command == 'email':
+        email_results(date, path)
+    else:
+        print(json.dumps(WorkQueue(path).counts(date if '--date' in sys.argv else None), indent=4))